@@ -15,12 +15,11 @@ Call with -l switch to loop until all sync tasks are complete, otherwise runs
 as a one-shot check.
 """
 
-import sys, os, argparse, time
-import simplejson as json
+import sys, argparse, time
 import helpers
 
 
-def check_running_tasks(clear):
+def check_running_tasks(org_id, clear):
     """
     Check for any currently running Sync tasks
     Checks for any Synchronize tasks in running/paused or Incomplete state.
@@ -28,31 +27,21 @@ def check_running_tasks(clear):
     #pylint: disable-msg=R0912,R0914,R0915
     # Clear the screen
     if clear:
-        os.system('clear')
+        sys.stdout.write(helpers.CLEAR)
 
     print helpers.HEADER + "Checking for running/paused yum sync tasks..." + helpers.ENDC
-    tasks = helpers.get_p_json(
-        helpers.FOREMAN_API + "tasks/", \
-            json.dumps(
-                {
-                    "per_page": "100",
-                }
-            ))
-
-    # From the list of tasks, look for any running export or sync jobs.
-    # If e have any we exit, as we can't export in this state.
+    tasks = helpers.get_task_snapshot(max_age=0)
+
+    # From the list of tasks, look for any running or paused sync jobs.
     running_sync = 0
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                running_sync = 1
-                print helpers.BOLD + "Running: " + helpers.ENDC \
-                    + task_result['input']['repository']['name']
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                running_sync = 1
-                print helpers.ERROR + "Paused:  " + helpers.ENDC \
-                    + task_result['input']['repository']['name']
+    for task_result in tasks.find('Synchronize', 'running'):
+        running_sync = 1
+        print helpers.BOLD + "Running: " + helpers.ENDC \
+            + task_result['input']['repository']['name']
+    for task_result in tasks.find('Synchronize', 'paused'):
+        running_sync = 1
+        print helpers.ERROR + "Paused:  " + helpers.ENDC \
+            + task_result['input']['repository']['name']
 
     if not running_sync:
         print helpers.GREEN + "None detected" + helpers.ENDC
@@ -60,26 +49,23 @@ def check_running_tasks(clear):
 
     # Check any repos marked as Sync Incomplete
     print helpers.HEADER + "\nChecking for incomplete (stopped) yum sync tasks..." + helpers.ENDC
-    repo_list = helpers.get_json(
-        helpers.KATELLO_API + "/content_view_versions")
+    inventory = helpers.get_repo_inventory(org_id, max_age=0)
 
     # Extract the list of repo ids, then check the state of each one.
+    repo_status_list = inventory.get_status(helpers.get_cv_repo_ids())
     incomplete_sync = 0
-    for repo in repo_list['results']:
-        for repo_id in repo['repositories']:
-            repo_status = helpers.get_json(
-                helpers.KATELLO_API + "/repositories/" + str(repo_id['id']))
-
-            if repo_status['content_type'] == 'yum':
-                if repo_status['last_sync'] is None:
-                    if repo_status['library_instance_id'] is None:
-#                        incomplete_sync = 1
-#                        print helpers.ERROR + "Broken Repo: " + helpers.ENDC + repo_status['name']
-                        print helpers.WARNING + "Never Synchronized: " + helpers.ENDC + repo_status['name']
-                elif repo_status['last_sync']['state'] == 'stopped':
-                    if repo_status['last_sync']['result'] == 'warning':
-                        incomplete_sync = 1
-                        print helpers.WARNING + "Incomplete: " + helpers.ENDC + repo_status['name']
+    for repo_id in sorted(repo_status_list):
+        repo_status = repo_status_list[repo_id]
+        if repo_status['content_type'] == 'yum':
+            if repo_status['last_sync'] is None:
+                if repo_status['library_instance_id'] is None:
+#                    incomplete_sync = 1
+#                    print helpers.ERROR + "Broken Repo: " + helpers.ENDC + repo_status['name']
+                    print helpers.WARNING + "Never Synchronized: " + helpers.ENDC + repo_status['name']
+            elif repo_status['last_sync']['state'] == 'stopped':
+                if repo_status['last_sync']['result'] == 'warning':
+                    incomplete_sync = 1
+                    print helpers.WARNING + "Incomplete: " + helpers.ENDC + repo_status['name']
 
     # If we have detected incomplete sync tasks, ask the user if they want to export anyway.
     # This isn't fatal, but *MAY* lead to inconsistent repositories on the dieconnected sat.
@@ -101,10 +87,20 @@ def main(args):
 
     parser = argparse.ArgumentParser(description='Checks status of yum repository sync tasks.')
     # pylint: disable=bad-continuation
+    parser.add_argument('-o', '--org', help='Organization (Uses default if not specified)',
+            required=False)
     parser.add_argument('-l', '--loop', help='Loop check until all tasks complete', required=False,
             action="store_true")
     args = parser.parse_args()
 
+    # Set our script variables from the input args
+    if args.org:
+        org_name = args.org
+    else:
+        org_name = helpers.ORG_NAME
+
+    # Get the org_id (Validates our connection to the API)
+    org_id = helpers.get_org_id(org_name)
 
     # Check if there are any currently running tasks that will conflict with an export
     # Loop until all tasks are compltete.
@@ -112,14 +108,14 @@ def main(args):
         try:
             while True:
                 clear = True
-                check_running_tasks(clear)
+                check_running_tasks(org_id, clear)
                 time.sleep(5)
         except KeyboardInterrupt:
             print "End"
 
     else:
         clear = False
-        check_running_tasks(clear)
+        check_running_tasks(org_id, clear)
 
 if __name__ == "__main__":
     try:
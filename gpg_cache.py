@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#title           :gpg_cache.py
+#description     :Inspects and prunes the sat_export GPG verification cache
+#URL             :https://github.com/RedHatSatellite/sat6_disconnected_tools
+#author          :Geoff Gatward <ggatward@redhat.com>
+#notes           :This script is NOT SUPPORTED by Red Hat Global Support Services.
+#license         :GPLv3
+#==============================================================================
+"""
+Inspects and prunes the cache of RPMs that have passed the sat_export GPG check.
+"""
+
+import sys, os, argparse, datetime
+import helpers
+
+
+def main(args):
+    """
+    Main Routine
+    """
+    parser = argparse.ArgumentParser(description='Inspects and prunes the GPG verification cache.')
+    group = parser.add_mutually_exclusive_group()
+    # pylint: disable=bad-continuation
+    group.add_argument('-p', '--prune', help='Remove entries not seen in the last PRUNE days',
+        required=False, type=int)
+    group.add_argument('-c', '--clear', help='Remove all entries from the cache', required=False,
+        action="store_true")
+    args = parser.parse_args()
+
+    # The cache lives in the same var dir as the export timestamps
+    vardir = os.path.join(os.path.dirname(__file__), 'var')
+    cache = helpers.GpgCache(vardir)
+
+    if args.prune is not None:
+        removed = cache.prune(args.prune)
+        msg = "Removed " + str(removed) + " GPG cache entries not seen in " + str(args.prune) + " days"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+    elif args.clear:
+        removed = cache.clear()
+        msg = "Removed all " + str(removed) + " GPG cache entries"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+
+    # Show the cache statistics
+    (count, oldest, newest) = cache.stats()
+    print "Verified RPMs in cache: " + str(count)
+    if count:
+        print "Oldest entry last seen: " + str(datetime.datetime.fromtimestamp(oldest))
+        print "Newest entry last seen: " + str(datetime.datetime.fromtimestamp(newest))
+    cache.close()
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except KeyboardInterrupt, e:
+        print >> sys.stderr, ("\n\nExiting on user cancel.")
+        sys.exit(1)
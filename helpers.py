@@ -9,9 +9,12 @@
 
 """Functions common to various Satellite 6 scripts"""
 
-import sys, os, time, datetime, argparse
-import logging
+import sys, os, time, datetime, argparse, tarfile, shutil, fnmatch
+import logging, atexit, sqlite3, zlib
 from time import sleep
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import hashlib
 from hashlib import sha256
 
 try:
@@ -26,6 +29,31 @@ except ImportError:
     print "Please install the PyYAML module."
     sys.exit(-1)
 
+import simplejson as json
+
+# scandir is built in to python 3.5+, and available as a module for older versions
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# xz compression is built in to python 3.3+, and available as a backport for older versions
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # Import the site-specific configs
 dir = os.path.dirname(__file__)
@@ -43,6 +71,16 @@ DEBUG = CONFIG["logging"]["debug"]
 EXPORTDIR = CONFIG["export"]["dir"]
 IMPORTDIR = CONFIG["import"]["dir"]
 SYNCBATCH = CONFIG["import"]["syncbatch"]
+EXPORTBATCH = CONFIG["export"].get("exportbatch", 4)
+COMPRESSION = CONFIG["export"].get("compression", "none")
+# Optional HTTP tuning parameters
+POOLSIZE = CONFIG["satellite"].get("poolsize", 10)
+TIMEOUT = CONFIG["satellite"].get("timeout", 120)
+WORKERS = CONFIG["satellite"].get("workers", 8)
+PAGESIZE = CONFIG["satellite"].get("pagesize", 1000)
+CACHETTL = CONFIG["satellite"].get("cachettl", 60)
+POLLMIN = CONFIG["satellite"].get("pollmin", 2)
+POLLMAX = CONFIG["satellite"].get("pollmax", 30)
 
 # 'Global' Satellite 6 parameters
 # Satellite API
@@ -51,6 +89,23 @@ SAT_API = "%s/katello/api/v2/" % URL
 KATELLO_API = "%s/katello/api/" % URL
 # Foreman_Tasks API
 FOREMAN_API = "%s/foreman_tasks/api/" % URL
+# Size of each archive chunk (DVD size, as per 'split -b 4200M')
+CHUNKSIZE = 4200 * 1024 * 1024
+# Read buffer size used when calculating file checksums
+HASH_BUFSIZE = 8 * 1024 * 1024
+# Size of each independently compressed block of the export archive
+COMPRESS_BLOCKSIZE = 16 * 1024 * 1024
+# Compression levels used for normal content, and for content that is already compressed.
+# Already compressed content is stored without compression where the format allows it
+# (gzip level 0, the fastest negative zstd level) - xz has no stored mode, so preset 0 is used.
+COMPRESS_LEVELS = {'gzip': (6, 0), 'xz': (6, 0), 'zstd': (3, -100)}
+# Leading bytes of each supported compression format
+COMPRESS_MAGIC = [('gzip', '\x1f\x8b'), ('xz', '\xfd7zXZ\x00'), ('zstd', '\x28\xb5\x2f\xfd')]
+# Archive members with these extensions are not worth compressing again
+COMPRESSED_EXTENSIONS = ('.rpm', '.drpm', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.jar')
+# Foreman search filters for running/paused tasks, with and without bulk actions
+ACTIVE_TASK_STATES = "(state = running or state = paused)"
+ACTIVE_TASK_SEARCH = ACTIVE_TASK_STATES + " and label != Actions::BulkAction"
 # HTML Headers for all API POST calls
 POST_HEADERS = {'content-type': 'application/json'}
 
@@ -66,6 +121,8 @@ ERROR = RED
 ENDC = '\033[0m'
 BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
+# Move the cursor to the top left and clear the screen
+CLEAR = '\033[H\033[2J'
 
 
 def who_is_running():
@@ -78,26 +135,75 @@ def who_is_running():
     return runuser
 
 
+# Define the shared HTTP session
+def new_session():
+    """
+    Create a HTTP session with a keep-alive connection pool of POOLSIZE.
+    All API calls share the session, so the TLS handshake and basic auth to
+    the Satellite are only done when a new connection is opened.
+    """
+    session = requests.Session()
+    session.auth = (USERNAME, PASSWORD)
+    session.verify = True
+    session.headers.update({'Connection': 'keep-alive'})
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=POOLSIZE,
+        pool_maxsize=POOLSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+SESSION = new_session()
+
+
+def connection_stats():
+    """
+    Return the number of API requests made, and how many connections were
+    opened or reused to service them
+    """
+    num_requests = 0
+    num_opened = 0
+    adapters = []
+    for adapter in SESSION.adapters.values():
+        if adapter not in adapters:
+            adapters.append(adapter)
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            num_requests += pools[key].num_requests
+            num_opened += pools[key].num_connections
+    return {'requests': num_requests,
+            'opened': num_opened,
+            'reused': max(num_requests - num_opened, 0)}
+
+
+def log_connection_stats():
+    """ Write the API connection counters to the log """
+    stats = connection_stats()
+    if stats['requests']:
+        msg = "API requests: " + str(stats['requests']) + ", connections opened: " \
+            + str(stats['opened']) + ", reused: " + str(stats['reused'])
+        log_msg(msg, 'DEBUG')
+
+
 # Define the GET and POST methods
 def get_json(location):
     """
     Performs a GET using the passed URL location
     """
-    result = requests.get(
+    result = SESSION.get(
         location,
-        auth=(USERNAME, PASSWORD),
-        verify=True)
+        timeout=TIMEOUT)
     return result.json()
 
 def get_p_json(location, json_data):
     """
     Performs a GET with input data to the URL location
     """
-    result = requests.get(
+    result = SESSION.get(
         location,
         data=json_data,
-        auth=(USERNAME, PASSWORD),
-        verify=True,
+        timeout=TIMEOUT,
         headers=POST_HEADERS)
     return result.json()
 
@@ -105,11 +211,10 @@ def put_json(location, json_data):
     """
     Performs a PUT and passes the data to the URL location
     """
-    result = requests.put(
+    result = SESSION.put(
         location,
         data=json_data,
-        auth=(USERNAME, PASSWORD),
-        verify=True,
+        timeout=TIMEOUT,
         headers=POST_HEADERS)
     return result.json()
 
@@ -117,15 +222,301 @@ def post_json(location, json_data):
     """
     Performs a POST and passes the data to the URL location
     """
-    result = requests.post(
+    result = SESSION.post(
         location,
         data=json_data,
-        auth=(USERNAME, PASSWORD),
-        verify=True,
+        timeout=TIMEOUT,
         headers=POST_HEADERS)
     return result.json()
 
 
+# Short lived cache of API lookups
+CACHE = {}
+
+def cache_get(key, loader, max_age=None):
+    """
+    Return the cached value for 'key', calling loader() to populate the cache
+    if there is no value or the value is older than max_age (CACHETTL) seconds.
+    """
+    if max_age is None:
+        max_age = CACHETTL
+    now = time.time()
+    if key in CACHE and now - CACHE[key][0] < max_age:
+        return CACHE[key][1]
+    value = loader()
+    CACHE[key] = (now, value)
+    return value
+
+
+def invalidate_cache(key=None):
+    """
+    Remove the given key from the cache, or empty the whole cache if no key is given
+    """
+    if key is None:
+        CACHE.clear()
+    else:
+        CACHE.pop(key, None)
+
+
+def parallel_map(func, items, workers=None):
+    """
+    Apply func to each item using a bounded pool of threads.
+    Results are returned in the same order as the input items.
+    """
+    items = list(items)
+    if not items:
+        return []
+    if workers is None:
+        workers = WORKERS
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        results = pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def get_repo_status(repo_ids):
+    """
+    Return the details of each given repository id, keyed by id.
+    Duplicate ids are only queried once, and the queries are run in parallel.
+    """
+    unique_ids = sorted(set(repo_ids))
+    results = parallel_map(
+        lambda repo_id: get_json(KATELLO_API + "/repositories/" + str(repo_id)), unique_ids)
+    return dict(zip(unique_ids, results))
+
+
+class APIError(Exception):
+    """ Raised when the API returns an error reply instead of the expected results """
+    pass
+
+
+def check_results(location, response):
+    """
+    Check that a reply from a list API call is a page of results.
+    Logs and raises an APIError if the reply is an error, e.g. a rejected search.
+    """
+    if not isinstance(response, dict):
+        msg = "Unexpected reply from " + location + ": " + str(response)
+    elif response.get('displayMessage') or response.get('error') or response.get('errors'):
+        # Successful Katello replies include an empty 'error' key
+        error = response.get('displayMessage') or response.get('error') or response.get('errors')
+        if isinstance(error, dict):
+            error = error.get('message', error)
+        msg = "API error from " + location + ": " + str(error)
+    elif 'results' not in response:
+        msg = "Reply from " + location + " contains no results"
+    else:
+        return response
+    log_msg(msg, 'ERROR')
+    raise APIError(msg)
+
+
+def iter_results(location, params=None, search=None, per_page=None, prefetch=False):
+    """
+    Generator that yields each result of a list API call, following the
+    pagination one page at a time. An APIError is raised if the API returns an
+    error instead of a page of results.
+    'search' is passed to the API as a server side search filter, e.g. 'state = running'
+    'per_page' overrides the configured PAGESIZE.
+    If 'prefetch' is set, the next page is requested on a background thread
+    whilst the results of the current page are being consumed.
+    """
+    if per_page is None:
+        per_page = PAGESIZE
+
+    def get_page(page):
+        """ Request a single page of results """
+        data = dict(params or {})
+        data['page'] = page
+        data['per_page'] = per_page
+        if search:
+            data['search'] = search
+        return check_results(location, get_p_json(location, json.dumps(data)))
+
+    pool = None
+    if prefetch:
+        pool = ThreadPool(1)
+    try:
+        page = 1
+        count = 0
+        response = get_page(page)
+        while True:
+            page_results = response['results']
+            total = response.get('subtotal', response.get('total'))
+            count += len(page_results)
+            more = bool(page_results) and total is not None and count < int(total)
+            if more and pool:
+                next_page = pool.apply_async(get_page, (page + 1,))
+            for result in page_results:
+                yield result
+            if not more:
+                break
+            page += 1
+            if pool:
+                response = next_page.get()
+            else:
+                response = get_page(page)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def get_all_results(location, params=None, search=None):
+    """
+    Performs a GET of a list API call, following the pagination until all
+    pages have been read. Returns the combined 'results' list.
+    """
+    return list(iter_results(location, params, search=search, prefetch=True))
+
+
+class LabelIndex(object):
+    """
+    Index of labels (e.g. repository labels) to their values, for exact and
+    suffix lookups. Exact lookups use a dict. Suffix lookups walk a trie of the
+    reversed labels, built on first use, so their cost depends on the length of the
+    suffix and the number of matches rather than the number of labels.
+    """
+    def __init__(self, items=()):
+        self.exact = {}
+        self.trie = None
+        for label, value in items:
+            self.exact[label] = value
+
+    def _build_trie(self):
+        """ Build the trie of reversed labels. The label ending at a node is kept under None """
+        self.trie = {}
+        for label in self.exact:
+            node = self.trie
+            for char in reversed(label):
+                node = node.setdefault(char, {})
+            node[None] = label
+
+    def get(self, label):
+        """ Return the value of the given label, or None """
+        return self.exact.get(label)
+
+    def suffix(self, suffix):
+        """
+        Return the values of all labels that end with the given suffix, where the
+        suffix starts at a word boundary (as the regex '\\b<suffix>$'), ordered by label.
+        """
+        if not suffix:
+            return []
+        if self.trie is None:
+            self._build_trie()
+        node = self.trie
+        for char in reversed(suffix):
+            node = node.get(char)
+            if node is None:
+                return []
+
+        # Every label below this node ends with the suffix
+        labels = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for char, child in node.iteritems():
+                if char is None:
+                    labels.append(child)
+                else:
+                    nodes.append(child)
+
+        first_is_word = is_word_char(suffix[0])
+        matches = [label for label in labels if len(label) == len(suffix)
+                   or is_word_char(label[-len(suffix) - 1]) != first_is_word]
+        return [self.exact[label] for label in sorted(matches)]
+
+    def find(self, label):
+        """
+        Return a list of the values matching the given label - the exact match
+        if there is one, otherwise all labels ending with it (see suffix)
+        """
+        if label in self.exact:
+            return [self.exact[label]]
+        return self.suffix(label)
+
+
+def is_word_char(char):
+    """ Return True if char is a regex word character (letter, digit or underscore) """
+    return char.isalnum() or char == '_'
+
+
+class RepoInventory(object):
+    """
+    In-memory index of the repositories in an organization.
+    Repositories can be looked up by id or by label. Where a label is used by
+    several repositories (content view copies), the Library instance is indexed.
+    """
+    def __init__(self, results):
+        self.results = results
+        self.by_id = {}
+        self.by_label = {}
+        for repo in results:
+            self.by_id[repo['id']] = repo
+            if repo['label'] not in self.by_label or repo.get('library_instance_id') is None:
+                self.by_label[repo['label']] = repo
+        self.label_index = None
+
+    def get_label_index(self):
+        """ Return a LabelIndex of the repositories indexed by label, built on first use """
+        if self.label_index is None:
+            self.label_index = LabelIndex(self.by_label.iteritems())
+        return self.label_index
+
+    def get_status(self, repo_ids):
+        """
+        Return the details of each given repository id, keyed by id.
+        Any ids not found in the inventory are queried directly.
+        """
+        repo_status = {}
+        missing = []
+        for repo_id in set(repo_ids):
+            if repo_id in self.by_id:
+                repo_status[repo_id] = self.by_id[repo_id]
+            else:
+                missing.append(repo_id)
+        repo_status.update(get_repo_status(missing))
+        return repo_status
+
+
+def get_repo_inventory(org_id, max_age=None):
+    """
+    Return a RepoInventory of all repositories in the given organization.
+    The inventory is cached for up to max_age (CACHETTL) seconds.
+    """
+    def load_inventory():
+        """ Read the repository listing from the API """
+        results = get_all_results(KATELLO_API + "/repositories/", {"organization_id": org_id})
+        msg = "Repository inventory loaded (" + str(len(results)) + " repos)"
+        log_msg(msg, 'DEBUG')
+        return RepoInventory(results)
+
+    return cache_get(('repos', org_id), load_inventory, max_age)
+
+
+def get_cv_repo_ids():
+    """
+    Return the ids of all repositories contained in content view versions
+    """
+    cv_versions = get_all_results(KATELLO_API + "/content_view_versions")
+    return [repo_id['id'] for ver in cv_versions for repo_id in ver['repositories']]
+
+
+def get_repo_packages(repo_id):
+    """
+    Return the checksum of each package in a repository, keyed by package filename
+    """
+    packages = {}
+    for package in iter_results(KATELLO_API + "packages/", {"repository_id": repo_id},
+            prefetch=True):
+        packages[package['filename']] = package.get('checksum')
+    return packages
+
+
 def valid_date(indate):
     """
     Check date format is valid
@@ -137,15 +528,594 @@ def valid_date(indate):
         raise argparse.ArgumentTypeError(msg)
 
 
+def file_digests(filename, algorithms=('sha256',)):
+    """
+    Calculate one or more checksums (e.g. sha256, md5, sha1) of a file in a single pass.
+    The file is read through a fixed size reusable buffer, so memory use does not
+    depend on the size of the file. Returns the hexdigests keyed by algorithm.
+    """
+    hashes = [(name, hashlib.new(name)) for name in algorithms]
+    buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
+    with open(filename, 'rb') as f_name:
+        while True:
+            size = f_name.readinto(buf)
+            if not size:
+                break
+            for name, digest in hashes:
+                digest.update(view[:size])
+    return dict((name, digest.hexdigest()) for name, digest in hashes)
+
+
 def sha256sum(filename):
     """
     Perform sha256sum of given file
     """
-    f_name = open(filename, 'rb')
-    shasum = (sha256(f_name.read()).hexdigest(), filename)
+    shasum = (file_digests(filename)['sha256'], filename)
     return shasum
 
 
+class SplitWriter(object):
+    """
+    File-like object that writes a stream of data directly into numbered chunk
+    files of CHUNKSIZE bytes (<basename>_00, <basename>_01, ...), calculating the
+    sha256sum of each chunk as it is written.
+    close() writes a <basename>.sha256 manifest that can be checked with 'sha256sum -c'
+    """
+    def __init__(self, basename, chunksize=CHUNKSIZE):
+        self.basename = basename
+        self.chunksize = chunksize
+        self.chunks = []
+        self.handle = None
+        self.chunkname = None
+        self.shasum = None
+        self.written = 0
+        self.total = 0
+
+    def _close_chunk(self):
+        """ Close the current chunk file and record its checksum """
+        if self.handle:
+            self.handle.close()
+            self.chunks.append((os.path.basename(self.chunkname), self.shasum.hexdigest()))
+            self.handle = None
+
+    def _next_chunk(self):
+        """ Start writing to a new chunk file """
+        self._close_chunk()
+        self.chunkname = self.basename + '_%02d' % len(self.chunks)
+        self.handle = open(self.chunkname, 'wb')
+        self.shasum = sha256()
+        self.written = 0
+
+    def write(self, data):
+        """ Write data, starting new chunks as each one fills """
+        offset = 0
+        while offset < len(data):
+            if self.handle is None or self.written >= self.chunksize:
+                self._next_chunk()
+            part = data[offset:offset + self.chunksize - self.written]
+            self.handle.write(part)
+            self.shasum.update(part)
+            self.written += len(part)
+            offset += len(part)
+        self.total += len(data)
+
+    def close(self):
+        """ Close the last chunk and write the sha256 manifest """
+        self._close_chunk()
+        with open(self.basename + '.sha256', 'w') as manifest:
+            for chunkname, digest in self.chunks:
+                manifest.write(digest + '  ' + chunkname + '\n')
+
+
+def read_sha256_manifest(shafile):
+    """
+    Read a sha256sum manifest file.
+    Returns a list of (filename, checksum) tuples ordered by the numeric part
+    suffix of each filename (_00, _01 ... _99, _100), so that the parts are read
+    back in the order they were written.
+    """
+    chunks = []
+    with open(shafile, 'r') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line:
+                continue
+            digest, filename = line.split(None, 1)
+            chunks.append((filename.lstrip('*'), digest.lower()))
+    return sorted(chunks, key=lambda chunk: part_number(chunk[0]))
+
+
+def part_number(filename):
+    """ Return the numeric suffix of an archive part filename, or -1 if it has none """
+    suffix = filename.rsplit('_', 1)[-1]
+    if suffix.isdigit():
+        return int(suffix)
+    return -1
+
+
+def hash_chunk(chunk):
+    """
+    Calculate the sha256sum of a chunk file.
+    'chunk' is a (filename, checksum) tuple. Returns (filename, checksum, calculated)
+    """
+    filename, digest = chunk
+    return (filename, digest, file_digests(filename)['sha256'])
+
+
+def verify_chunks(chunks, workers=None):
+    """
+    Verify the sha256sum of each chunk file, hashing several chunks at once in a
+    pool of processes. 'chunks' is a list of (filename, checksum) tuples.
+    Stops at the first mismatch. Returns True if all chunks are valid.
+    """
+    if not chunks:
+        return True
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(max(1, min(workers, len(chunks))))
+    try:
+        for filename, digest, calculated in pool.imap_unordered(hash_chunk, chunks):
+            if calculated != digest.lower():
+                msg = filename + ": FAILED"
+                log_msg(msg, 'ERROR')
+                return False
+            msg = filename + ": OK"
+            log_msg(msg, 'INFO')
+            print msg
+    finally:
+        pool.terminate()
+        pool.join()
+    return True
+
+
+class ChunkReader(object):
+    """
+    File-like object that presents a list of chunk files as one continuous stream.
+    'chunks' is a list of (filename, checksum) as returned by read_sha256_manifest.
+    The sha256sum of each chunk is verified as its data is read, and an IOError
+    is raised if a chunk does not match.
+    """
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.index = 0
+        self.handle = None
+        self.shasum = None
+        self.total = 0
+
+    def _end_chunk(self):
+        """ Verify the checksum of the chunk just read and move on to the next """
+        self.handle.close()
+        self.handle = None
+        chunkname, digest = self.chunks[self.index]
+        self.index += 1
+        if self.shasum.hexdigest() != digest:
+            raise IOError("Checksum verification failed for " + chunkname)
+        msg = chunkname + ": OK"
+        log_msg(msg, 'INFO')
+        print msg
+
+    def read(self, size=-1):
+        """ Read up to size bytes, moving through the chunks as each one ends """
+        data = []
+        while size != 0:
+            if self.handle is None:
+                if self.index >= len(self.chunks):
+                    break
+                self.handle = open(self.chunks[self.index][0], 'rb')
+                self.shasum = sha256()
+            if size > 0:
+                part = self.handle.read(size)
+            else:
+                part = self.handle.read(1024 * 1024)
+            if not part:
+                self._end_chunk()
+                continue
+            self.shasum.update(part)
+            self.total += len(part)
+            data.append(part)
+            if size > 0:
+                size -= len(part)
+        return ''.join(data)
+
+    def finish(self):
+        """ Read and verify any data remaining after the end of the archive """
+        while self.read(1024 * 1024):
+            pass
+
+
+def compression_method(method):
+    """
+    Return the compression method to use for the requested one, falling back
+    to gzip if the python module needed for xz or zstd is not installed.
+    """
+    if method in (None, 'none'):
+        return 'none'
+    if method not in COMPRESS_LEVELS:
+        msg = "Unknown compression method '" + str(method) + "', using gzip"
+        log_msg(msg, 'WARNING')
+        return 'gzip'
+    if (method == 'xz' and lzma is None) or (method == 'zstd' and zstandard is None):
+        msg = "Python module for " + method + " compression is not installed, using gzip"
+        log_msg(msg, 'WARNING')
+        return 'gzip'
+    return method
+
+
+def compress_block(method, level, data):
+    """
+    Compress a block of data into a complete, self contained gzip member,
+    xz stream or zstd frame. Concatenated blocks form a valid compressed stream.
+    """
+    if method == 'xz':
+        return lzma.compress(data, preset=level)
+    elif method == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    # wbits of 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressWriter(object):
+    """
+    File-like object that compresses the data written to it in independent blocks
+    of COMPRESS_BLOCKSIZE bytes, compressing several blocks at once in a pool of
+    threads (up to WORKERS). Compressed blocks are written to fileobj in their
+    original order.
+    """
+    def __init__(self, fileobj, method, workers=None):
+        self.fileobj = fileobj
+        self.method = method
+        self.fast = False
+        self.levels = COMPRESS_LEVELS[method]
+        self.block = []
+        self.blocksize = 0
+        self.total = 0
+        if method == 'zstd':
+            # Older versions of the zstandard module do not support the negative levels
+            try:
+                zstandard.ZstdCompressor(level=self.levels[1])
+            except (ValueError, zstandard.ZstdError):
+                self.levels = (self.levels[0], 1)
+        # Each worker can hold two blocks, so the pool size also bounds memory use
+        if workers is None:
+            workers = min(multiprocessing.cpu_count(), WORKERS)
+        self.workers = max(1, workers)
+        self.pool = ThreadPool(self.workers)
+        self.pending = []
+
+    def _flush_block(self):
+        """ Queue the current block for compression """
+        if not self.block:
+            return
+        level = self.levels[1 if self.fast else 0]
+        data = ''.join(self.block)
+        self.block = []
+        self.blocksize = 0
+        self.pending.append(self.pool.apply_async(compress_block, (self.method, level, data)))
+        # Limit the number of blocks held in memory
+        while len(self.pending) > self.workers * 2:
+            self.fileobj.write(self.pending.pop(0).get())
+
+    def set_fast(self, fast):
+        """
+        Select the fast compression level for content that is already compressed.
+        The level applies from the next block, so the current block is ended early.
+        """
+        if fast != self.fast:
+            self._flush_block()
+            self.fast = fast
+
+    def write(self, data):
+        """ Add data to the current block, queuing each block as it fills """
+        self.total += len(data)
+        offset = 0
+        while offset < len(data):
+            part = data[offset:offset + COMPRESS_BLOCKSIZE - self.blocksize]
+            self.block.append(part)
+            self.blocksize += len(part)
+            offset += len(part)
+            if self.blocksize >= COMPRESS_BLOCKSIZE:
+                self._flush_block()
+
+    def tell(self):
+        """ Return the number of uncompressed bytes written """
+        return self.total
+
+    def close(self):
+        """ Compress the last block and write out all remaining compressed data """
+        try:
+            self._flush_block()
+            for result in self.pending:
+                self.fileobj.write(result.get())
+            self.pending = []
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class CompressTarFile(tarfile.TarFile):
+    """
+    TarFile writing to a CompressWriter, that switches to the fast compression level
+    for large members that are already compressed (RPMs, compressed tarballs etc).
+    """
+    def addfile(self, tarinfo, fileobj=None):
+        # Small files are left in the current block rather than ending it early
+        if tarinfo.isreg() and tarinfo.size >= COMPRESS_BLOCKSIZE / 16:
+            self.fileobj.set_fast(tarinfo.name.endswith(COMPRESSED_EXTENSIONS))
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+
+
+# Errors raised by the decompressors for corrupt data
+DECOMPRESS_ERRORS = (zlib.error,)
+if lzma is not None:
+    DECOMPRESS_ERRORS += (lzma.LZMAError,)
+if zstandard is not None:
+    DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+
+def new_decompressor(method):
+    """ Return a decompressor object for a single gzip member, xz stream or zstd frame """
+    if method == 'xz':
+        return lzma.LZMADecompressor()
+    elif method == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+
+class DecompressReader(object):
+    """
+    File-like object that reads an archive stream from fileobj, detecting the
+    compression from its leading bytes. A stream made up of several concatenated
+    compressed blocks is decompressed as one. Uncompressed data is passed through.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = fileobj.read(6)
+        self.method = 'none'
+        for method, magic in COMPRESS_MAGIC:
+            if self.pending.startswith(magic):
+                self.method = method
+        if (self.method == 'xz' and lzma is None) or \
+                (self.method == 'zstd' and zstandard is None):
+            raise IOError("Python module for " + self.method + " decompression is not installed")
+        self.decompressor = None
+        if self.method != 'none':
+            self.decompressor = new_decompressor(self.method)
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        """ Refill the buffer with the next data from the stream. Returns False at the end """
+        self.buf = ''
+        self.pos = 0
+        while not self.buf:
+            data = self.pending or self.fileobj.read(1024 * 1024)
+            self.pending = ''
+            if not data:
+                return False
+            if self.decompressor is None:
+                self.buf = data
+                continue
+            output = []
+            while data:
+                # Report corrupt data the same way as a failed checksum
+                try:
+                    output.append(self.decompressor.decompress(data))
+                except DECOMPRESS_ERRORS, e:
+                    raise IOError("Decompression of archive failed - " + str(e))
+                data = self.decompressor.unused_data
+                # Any data after the end of a block is the start of the next one
+                if data or getattr(self.decompressor, 'eof', False):
+                    self.decompressor = new_decompressor(self.method)
+            self.buf = ''.join(output)
+        return True
+
+    def read(self, size=-1):
+        """ Read up to size bytes of uncompressed data """
+        data = []
+        while size != 0:
+            if self.pos >= len(self.buf) and not self._fill():
+                break
+            if size > 0:
+                part = self.buf[self.pos:self.pos + size]
+                size -= len(part)
+            else:
+                part = self.buf[self.pos:]
+            self.pos += len(part)
+            data.append(part)
+        return ''.join(data)
+
+
+def write_split_tar(source_dir, basename, compression=None):
+    """
+    Write a tar archive of source_dir directly into DVD sized chunks with a sha256
+    manifest, in a single pass over the content. The archive is compressed with
+    the configured compression method unless one is given.
+    Returns the SplitWriter used.
+    """
+    method = compression_method(compression or COMPRESSION)
+    writer = SplitWriter(basename)
+    os.chdir(source_dir)
+    start = time.time()
+    if method == 'none':
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            archive.add(os.curdir, recursive=True)
+        size = writer.total
+    else:
+        compressor = CompressWriter(writer, method)
+        try:
+            with CompressTarFile(fileobj=compressor, mode='w') as archive:
+                archive.add(os.curdir, recursive=True)
+        finally:
+            compressor.close()
+        size = compressor.total
+    writer.close()
+    elapsed = max(time.time() - start, 0.001)
+    msg = "Wrote " + str(writer.total) + " bytes in " + str(len(writer.chunks)) + " chunks"
+    log_msg(msg, 'INFO')
+    if method != 'none':
+        msg = "Compressed " + str(size / (1024 * 1024)) + " MB to " + \
+            str(writer.total / (1024 * 1024)) + " MB with " + method + " (ratio " + \
+            str(round(float(size) / max(writer.total, 1), 2)) + ")"
+        log_msg(msg, 'INFO')
+    msg = "Archived " + str(size / (1024 * 1024)) + " MB in " + str(int(elapsed)) + "s (" + \
+        str(round(size / elapsed / (1024 * 1024), 1)) + " MB/s)"
+    log_msg(msg, 'INFO')
+    return writer
+
+
+class GpgCache(object):
+    """
+    Persistent record of RPMs that have passed the GPG check, stored in an
+    sqlite database in the given var directory.
+    Entries are keyed by the RPM path within the export tree, and are only
+    valid while the size and modification time of the file are unchanged.
+    """
+    def __init__(self, vardir):
+        if not os.path.exists(vardir):
+            os.makedirs(vardir)
+        self.conn = sqlite3.connect(os.path.join(vardir, 'gpg_cache.db'))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS verified (path TEXT PRIMARY KEY, "
+                          "size INTEGER, mtime INTEGER, verified REAL, last_seen REAL)")
+        self.conn.commit()
+
+    def get_verified(self):
+        """ Return the (size, mtime) of every verified RPM, keyed by path """
+        rows = self.conn.execute("SELECT path, size, mtime FROM verified")
+        return dict((path, (size, mtime)) for path, size, mtime in rows)
+
+    def mark_seen(self, paths):
+        """ Record that the given verified RPMs were seen in this export """
+        now = time.time()
+        self.conn.executemany("UPDATE verified SET last_seen = ? WHERE path = ?",
+                              [(now, path) for path in paths])
+        self.conn.commit()
+
+    def add_verified(self, entries):
+        """ Record RPMs that passed the GPG check. 'entries' is a list of (path, size, mtime) """
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?)",
+                              [(path, size, mtime, now, now) for path, size, mtime in entries])
+        self.conn.commit()
+
+    def stats(self):
+        """ Return the number of entries and the oldest/newest last seen times """
+        return self.conn.execute(
+            "SELECT COUNT(*), MIN(last_seen), MAX(last_seen) FROM verified").fetchone()
+
+    def prune(self, days):
+        """ Remove entries not seen within the given number of days. Returns the count removed """
+        cursor = self.conn.execute("DELETE FROM verified WHERE last_seen < ?",
+                                   (time.time() - days * 86400,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def clear(self):
+        """ Remove all entries. Returns the count removed """
+        cursor = self.conn.execute("DELETE FROM verified")
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        """ Close the database """
+        self.conn.close()
+
+
+def list_dir(path):
+    """
+    Return (name, path, is_dir) for each entry in a directory, following symlinks.
+    Uses scandir where it is available to avoid a stat call per entry.
+    """
+    if scandir:
+        return [(entry.name, entry.path, entry.is_dir()) for entry in scandir(path)]
+    return [(name, os.path.join(path, name), os.path.isdir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+
+def scan_files(root, since=None, pattern=None):
+    """
+    Walk the tree under root following symlinks (as per 'find -L') and return
+    (path, stat) for each file.
+    'since' limits the files to those with a ctime after the given epoch time
+    'pattern' limits the files to those with a name matching the glob pattern
+    """
+    files = []
+    seen = set()
+    dirs = [root]
+    while dirs:
+        current = dirs.pop()
+        dirstat = os.stat(current)
+        if (dirstat.st_dev, dirstat.st_ino) in seen:
+            continue
+        seen.add((dirstat.st_dev, dirstat.st_ino))
+        for name, path, is_dir in list_dir(current):
+            if is_dir:
+                dirs.append(path)
+                continue
+            if pattern and not fnmatch.fnmatch(name, pattern):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Broken symlink
+                continue
+            if since is not None and stat.st_ctime <= since:
+                continue
+            files.append((path, stat))
+    return files
+
+
+def collect_files(roots, dest, since=None, pattern=None):
+    """
+    Copy all files below each of the given roots into dest, keeping the full source
+    path of each file (as per 'cp --parents'). Symlinks are followed.
+    'since' (YYYY-MM-DD ...) limits the files to those changed since that date
+    'pattern' limits the files to those with a name matching the glob pattern
+    Returns the number of files and bytes collected.
+    """
+    cutoff = None
+    if since:
+        cutoff = time.mktime(datetime.datetime.strptime(since[:10], '%Y-%m-%d').timetuple())
+    files = []
+    for root in roots:
+        files.extend(scan_files(root, cutoff, pattern))
+    return copy_files(files, dest)
+
+
+def copy_files(files, dest):
+    """
+    Copy the given files into dest, keeping the full source path of each file.
+    'files' is a list of (path, stat) as returned by scan_files.
+    Files are copied using a pool of threads. They are never hardlinked, as a link
+    changes the ctime of the live pulp content that date based exports select on.
+    Returns the number of files and bytes copied.
+    """
+    to_copy = []
+    numbytes = 0
+    for path, stat in files:
+        target = dest + os.path.abspath(path)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        if os.path.lexists(target):
+            os.remove(target)
+        numbytes += stat.st_size
+        to_copy.append((path, target, stat))
+
+    def copy_file(item):
+        """ Copy a file preserving its mode, times and ownership """
+        path, target, stat = item
+        shutil.copy2(path, target)
+        if os.geteuid() == 0:
+            os.chown(target, stat.st_uid, stat.st_gid)
+
+    parallel_map(copy_file, to_copy)
+
+    msg = "Collected " + str(len(files)) + " files (" + str(numbytes / (1024 * 1024)) + " MB)"
+    log_msg(msg, 'INFO')
+    return (len(files), numbytes)
+
+
 def disk_usage(path):
     """Return disk usage associated with path, in percent."""
     stat = os.statvfs(path)
@@ -210,6 +1180,69 @@ class ProgressBar:
         return str(self.prog_bar)
 
 
+# Totals of all task polling done by this script
+POLL_STATS = {'polls': 0, 'waited': 0.0, 'longest': 0.0}
+
+class TaskPoller(object):
+    """
+    Adaptive poll interval for waiting on foreman tasks.
+    The interval starts at POLLMIN seconds and doubles after each poll, up to
+    POLLMAX seconds. The progress reported by each task is used to estimate when
+    the first one will complete, and the next poll is not scheduled after that.
+    """
+    def __init__(self):
+        self.interval = POLLMIN
+        self.first_seen = {}
+        self.remaining = None
+        self.polls = 0
+        self.waited = 0.0
+
+    def update(self, task_id, progress):
+        """ Record the progress (0.0 - 1.0) of a task at this poll """
+        now = time.time()
+        if task_id not in self.first_seen:
+            self.first_seen[task_id] = (now, progress)
+            return
+        start, start_progress = self.first_seen[task_id]
+        if progress is None or progress <= start_progress or progress >= 1:
+            return
+        rate = (progress - start_progress) / (now - start)
+        remaining = (1 - progress) / rate
+        if self.remaining is None or remaining < self.remaining:
+            self.remaining = remaining
+
+    def wait(self):
+        """ Sleep until the next poll is due """
+        delay = self.interval
+        if self.remaining is not None:
+            delay = min(delay, self.remaining)
+        delay = max(POLLMIN, min(delay, POLLMAX))
+        sleep(delay)
+        self.interval = min(self.interval * 2, POLLMAX)
+        self.remaining = None
+        self.polls += 1
+        self.waited += delay
+        POLL_STATS['polls'] += 1
+        POLL_STATS['waited'] += delay
+        POLL_STATS['longest'] = max(POLL_STATS['longest'], delay)
+
+    def log_stats(self, label):
+        """ Write the poll count and average interval to the log """
+        if self.polls:
+            msg = label + ": polled " + str(self.polls) + " times, average interval " \
+                + str(round(self.waited / self.polls, 1)) + "s"
+            log_msg(msg, 'DEBUG')
+
+
+def log_poll_stats():
+    """ Write the task polling totals to the log """
+    if POLL_STATS['polls']:
+        msg = "Task polls: " + str(POLL_STATS['polls']) + ", total wait: " \
+            + str(round(POLL_STATS['waited'], 1)) + "s, longest interval: " \
+            + str(round(POLL_STATS['longest'], 1)) + "s"
+        log_msg(msg, 'DEBUG')
+
+
 def wait_for_task(task_id, label):
     """
     Wait for the given task ID to complete
@@ -221,6 +1254,7 @@ def wait_for_task(task_id, label):
     log_msg(msg, 'INFO')
     # Force the status message to be shown to the user
     sys.stdout.flush()
+    poller = TaskPoller()
     while True:
         info = get_json(FOREMAN_API + "tasks/" + str(task_id))
         if info['state'] == 'paused' and info['result'] == 'error':
@@ -229,7 +1263,57 @@ def wait_for_task(task_id, label):
             break
         if info['pending'] != 1:
             break
-        sleep(30)
+        poller.update(task_id, info.get('progress'))
+        poller.wait()
+    poller.log_stats(label + " " + str(task_id))
+
+
+def get_task_states(task_ids):
+    """
+    Return the current details of each of the given task IDs, keyed by task ID.
+    All tasks are queried with a single search request.
+    """
+    task_ids = [str(task_id) for task_id in task_ids]
+    tasks = {}
+    if task_ids:
+        search = "id ^ (" + ", ".join(task_ids) + ")"
+        for task in iter_results(FOREMAN_API + "tasks/", search=search):
+            tasks[str(task['id'])] = task
+    # Query any tasks not returned by the search directly
+    for task_id in task_ids:
+        if task_id not in tasks:
+            tasks[task_id] = get_json(FOREMAN_API + "tasks/" + task_id)
+    return tasks
+
+
+def task_finished(info):
+    """ Return True if the given task details show the task is no longer pending """
+    if info['state'] == 'paused' and info['result'] == 'error':
+        return True
+    return info['pending'] != 1
+
+
+def wait_for_tasks(task_ids, label):
+    """
+    Wait for at least one of the given task IDs to complete.
+    All tasks are polled together. Returns the details of each completed
+    task, keyed by task ID.
+    """
+    poller = TaskPoller()
+    while True:
+        finished = {}
+        for task_id, info in get_task_states(task_ids).items():
+            if task_finished(info):
+                if info['state'] == 'paused' and info['result'] == 'error':
+                    msg = "Error with " + label + " " + task_id
+                    log_msg(msg, 'ERROR')
+                finished[task_id] = info
+            else:
+                poller.update(task_id, info.get('progress'))
+        if finished:
+            poller.log_stats(label)
+            return finished
+        poller.wait()
 
 
 def get_task_status(task_id):
@@ -243,76 +1327,133 @@ def get_task_status(task_id):
     return info
 
 
-# Get details about Content Views and versions
 def watch_tasks(task_list, ref_list, task_name):
     """
     Watch the status of tasks provided in taskList.
-    Loops until all tasks in the list have completed.
+    Loops until all tasks in the list have completed. All outstanding tasks are
+    queried together each cycle, and completed tasks are no longer polled.
+    Returns the final 'name', 'state', 'result' and 'progress' of each task,
+    keyed by task ID.
     """
+    if not task_list:
+        print "ERROR (watchTasks): no tasks passed to us"
+        return {}
 
-    # Seed the pendingList dictionary so all tasks are pending
-    pending_list = {}
+    # Seed the results so all tasks are pending
+    results = {}
+    pending = []
     for task_id in task_list:
-        pending_list[task_id] = "true"
+        results[str(task_id)] = {'name': str(ref_list[task_id]), 'state': 'planned',
+                                 'result': 'pending', 'progress': 0.0}
+        pending.append(str(task_id))
 
-    # Loop through each task and check current status
-    do_loop = 1
-    sleep_time = 10
+    poller = TaskPoller()
     failure = False
-    while do_loop == 1:
-        if len(task_list) >= 1:
-            os.system('clear')
-            print BOLD + task_name + ENDC
-
-            for task_id in task_list:
-
-                # Whilst there are pending tasks, loop through the task status
-                if 'true' in pending_list.values():
-                    # Query API to get status of current task
-                    status = get_json(
-                        FOREMAN_API + "tasks/" + str(task_id))
-
-                    # The result we get back is a floating number - we need to convert to a %
-                    pct_done = (status['progress'] * 100)
-                    pct_done1 = round(pct_done, 1)
-
-                    if status['result'] == 'success':
-                        colour = GREEN
-                    elif status['result'] == 'pending':
-                        colour = YELLOW
-                    else:
-                        colour = RED
-                        failure = True
-
-                    # Call the progress bar class
-                    p = ProgressBar(100)
-                    p.update_time(pct_done1)
-                    print colour + str(ref_list[task_id]) + ':' + ENDC
-                    print p
-
-
-                    if status['result'] != "pending":
-                        # Update the pendingList dictionary to say this task is done
-                        pending_list[task_id] = "false"
-                else:
-                    # All tasks are complete - end the loop
-                    do_loop = 0
-                    sleep_time = 0
-                    continue
+    while pending:
+        # Query API to get the status of all outstanding tasks
+        for task_id, status in get_task_states(pending).items():
+            results[task_id]['state'] = status['state']
+            results[task_id]['result'] = status['result']
+            results[task_id]['progress'] = status['progress']
+            if status['result'] != 'pending':
+                # This task is done - stop polling it
+                pending.remove(task_id)
+                if status['result'] != 'success':
+                    failure = True
+            else:
+                poller.update(task_id, status['progress'])
+
+        # Redraw the status of every task from the top of the screen
+        sys.stdout.write(CLEAR)
+        print BOLD + task_name + ENDC
+        for task_id in task_list:
+            task = results[str(task_id)]
+            if task['result'] == 'success':
+                colour = GREEN
+            elif task['result'] == 'pending':
+                colour = YELLOW
+            else:
+                colour = RED
 
-            # Sleep for 10 seconds between checks
-            time.sleep(sleep_time)
-        else:
-            do_loop = 0
-            print "ERROR (watchTasks): no tasks passed to us"
+            # The progress we get back is a floating number - we need to convert to a %
+            p = ProgressBar(100)
+            p.update_time(round(task['progress'] * 100, 1))
+            print colour + task['name'] + ':' + ENDC
+            print p
+        sys.stdout.flush()
+
+        if pending:
+            poller.wait()
 
     # All tasks are complete if we get here.
+    poller.log_stats(task_name)
     msg = task_name + " complete"
     log_msg(msg, 'INFO')
     if failure:
         print RED + "\nNot all tasks completed successfully" + ENDC
     else:
         print GREEN + "\nAll tasks complete" + ENDC
+    return results
+
+
+class TaskSnapshot(object):
+    """
+    Index of the active (running or paused) foreman tasks.
+    Tasks are indexed by their humanized action and state, and by the repository
+    label or content view id that they are acting on.
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.index = {}
+        for task in tasks:
+            action = task['humanized']['action']
+            state = task['state']
+            task_input = task.get('input') or {}
+            keys = [(action, state, None, None)]
+            if isinstance(task_input.get('repository'), dict):
+                keys.append((action, state, task_input['repository'].get('label'), None))
+            if isinstance(task_input.get('content_view'), dict):
+                keys.append((action, state, None, task_input['content_view'].get('id')))
+            for key in keys:
+                self.index.setdefault(key, []).append(task)
+
+    def find(self, action, state, label=None, cvid=None):
+        """
+        Return the tasks with the given action and state, optionally limited to
+        those acting on a given repository label or content view id
+        """
+        return self.index.get((action, state, label, cvid), [])
+
+
+def get_task_snapshot(max_age=None, include_bulk=False):
+    """
+    Return a TaskSnapshot of the running and paused tasks.
+    The state filter is applied by the server, and bulk actions are excluded
+    unless include_bulk is set. Exits if the tasks cannot be read, as callers
+    rely on the snapshot to know it is safe to start a sync or export.
+    The snapshot is cached for up to max_age (CACHETTL) seconds - callers that
+    start new tasks should call invalidate_cache('tasks').
+    """
+    if include_bulk:
+        search = ACTIVE_TASK_STATES
+        key = 'bulk_tasks'
+    else:
+        search = ACTIVE_TASK_SEARCH
+        key = 'tasks'
+
+    def load_snapshot():
+        """ Read the active tasks from the API """
+        try:
+            tasks = list(iter_results(FOREMAN_API + "tasks/", search=search))
+        except APIError:
+            msg = "Unable to check for running tasks - cannot continue"
+            log_msg(msg, 'ERROR')
+            sys.exit(-1)
+        msg = "Active task snapshot loaded (" + str(len(tasks)) + " tasks)"
+        log_msg(msg, 'DEBUG')
+        return TaskSnapshot(tasks)
+
+    return cache_get(key, load_snapshot, max_age)
 
 
 def check_running_sync():
@@ -320,22 +1461,18 @@ def check_running_sync():
     Check for any currently running Sync tasks
     Exits script if any Synchronize or Export tasks are found in a running state.
     """
-    tasks = get_json(
-        FOREMAN_API + "tasks/")
+    tasks = get_task_snapshot()
 
     # From the list of tasks, look for any running sync jobs.
     # If e have any we exit, as we can't trigger a new sync in this state.
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                msg = "Unable to start sync - a Sync task is currently running"
-                log_msg(msg, 'ERROR')
-                sys.exit(-1)
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                msg = "Unable to start sync - a Sync task is paused. Resume any paused sync tasks."
-                log_msg(msg, 'ERROR')
-                sys.exit(-1)
+    if tasks.find('Synchronize', 'running'):
+        msg = "Unable to start sync - a Sync task is currently running"
+        log_msg(msg, 'ERROR')
+        sys.exit(-1)
+    if tasks.find('Synchronize', 'paused'):
+        msg = "Unable to start sync - a Sync task is paused. Resume any paused sync tasks."
+        log_msg(msg, 'ERROR')
+        sys.exit(-1)
 
 
 def check_running_publish(cvid, desc):
@@ -343,41 +1480,20 @@ def check_running_publish(cvid, desc):
     Check for any currently running Promotion/Publication tasks
     Exits script if any Publish/Promote tasks are found in a running state.
     """
-    #pylint: disable-msg=R0912,R0914,R0915
-    tasks = get_json(
-        FOREMAN_API + "tasks/")
-
-    # From the list of tasks, look for any running sync jobs.
-    # If e have any we exit, as we can't trigger a new sync in this state.
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Publish':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by another task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Publish':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a paused task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Promotion':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by another task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Promotion':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a paused task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
+    tasks = get_task_snapshot()
+
+    # From the list of tasks, look for any running publish or promote jobs.
+    for action in ['Publish', 'Promotion']:
+        if tasks.find(action, 'running', cvid=cvid):
+            msg = "Unable to start '" + desc + "': content view is locked by another task"
+            log_msg(msg, 'WARNING')
+            locked = True
+            return locked
+        if tasks.find(action, 'paused', cvid=cvid):
+            msg = "Unable to start '" + desc + "': content view is locked by a paused task"
+            log_msg(msg, 'WARNING')
+            locked = True
+            return locked
 
 
 def query_yes_no(question, default="yes"):
@@ -449,3 +1565,7 @@ def log_msg(msg, level):
     # Otherwise if we ARE in debug, write everything to the log AND stdout
     else:
         logging.info(msg)
+
+# Record the API connection and task polling usage when the script exits
+atexit.register(log_connection_stats)
+atexit.register(log_poll_stats)
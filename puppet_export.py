@@ -10,95 +10,98 @@
 Exports Puppet modules.
 """
 
-import sys, argparse, datetime, os, shutil
-import fnmatch, subprocess, tarfile
+import sys, argparse, datetime, os, shutil, pickle
+import fnmatch, subprocess
 import simplejson as json
 from glob import glob
 import helpers
 
+# Location of the published puppet repositories
+PUPPET_REPODIR = '/var/lib/pulp/published/puppet/http/repos'
+
 
 # Promote a content view version
-def export_puppet(last_export, export_type):
+def export_puppet(last_export, export_type, shipped=None):
     """
     Export Puppet modules
-    Takes the type (full/incr) and the date of the last run
+    Takes the type (full/incr) and the date of the last run.
+    If the manifest of previously shipped files is given, the files that are not
+    in it with the same checksum are exported instead, regardless of their date.
+    Returns the manifest of all current puppet repo files {path: sha256}
     """
     PUPEXPORTDIR = helpers.EXPORTDIR + '/puppet'
     if not os.path.exists(PUPEXPORTDIR):
         print "Creating puppet export directory"
         os.makedirs(PUPEXPORTDIR)
 
-    if export_type == 'full':
+    # Checksum the published modules so we know exactly what the target has after this export
+    files = helpers.scan_files(PUPPET_REPODIR)
+    digests = helpers.parallel_map(lambda item: helpers.file_digests(item[0])['sha256'], files)
+    current = dict((path, digest) for (path, stat), digest in zip(files, digests))
+
+    if shipped is not None:
+        msg = "Exporting puppet modules not previously exported"
+    elif export_type == 'full':
         msg = "Exporting all puppet modules"
     else:
         msg = "Exporting puppet modules from start date " + last_export
     helpers.log_msg(msg, 'INFO')
 
-    if export_type == 'full':
-        os.system("find -L /var/lib/pulp/published/puppet/http/repos -type f -exec cp --parents -Lrp {} " \
-            + PUPEXPORTDIR + " \;")
+    if shipped is not None:
+        new_files = [(path, stat) for (path, stat) in files if shipped.get(path) != current[path]]
+        helpers.copy_files(new_files, PUPEXPORTDIR)
+
+    elif export_type == 'full':
+        helpers.collect_files([PUPPET_REPODIR], PUPEXPORTDIR)
 
     else:
-        os.system('find -L /var/lib/pulp/published/puppet/http/repos -type f -newerct $(date +%Y-%m-%d -d "' \
-            + last_export + '") -exec cp --parents -Lrp {} ' + PUPEXPORTDIR + ' \;')
+        helpers.collect_files([PUPPET_REPODIR], PUPEXPORTDIR, since=last_export)
 
-    return
+    return current
 
 
-def check_running_tasks():
+def check_running_tasks(org_id):
     """
     Check for any currently running Sync or Export tasks
     Exits script if any Synchronize or Export tasks are found in a running state.
     """
-    tasks = helpers.get_json(
-        helpers.FOREMAN_API + "tasks/")
+    # Bulk sync and export actions are checked too
+    tasks = helpers.get_task_snapshot(include_bulk=True)
 
     # From the list of tasks, look for any running export or sync jobs.
     # If e have any we exit, as we can't export in this state.
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running':
-            if task_result['humanized']['action'] == 'Export':
-                msg = "Unable to export - an Export task is already running"
-                helpers.log_msg(msg, 'ERROR')
-                sys.exit(-1)
-            if task_result['humanized']['action'] == 'Synchronize':
-                msg = "Unable to export - a Sync task is currently running"
-                helpers.log_msg(msg, 'ERROR')
-                sys.exit(-1)
-        if task_result['state'] == 'paused':
-            if task_result['humanized']['action'] == 'Export':
-                msg = "Unable to export - an Export task is paused. Please resolve this issue first"
-                helpers.log_msg(msg, 'ERROR')
-                sys.exit(-1)
-            if task_result['humanized']['action'] == 'Synchronize':
-                msg = "Unable to export - a Sync task is paused. Resume any paused sync tasks."
-                helpers.log_msg(msg, 'ERROR')
-                sys.exit(-1)
+    checks = [
+        ('Export', 'running', "Unable to export - an Export task is already running"),
+        ('Synchronize', 'running', "Unable to export - a Sync task is currently running"),
+        ('Export', 'paused', "Unable to export - an Export task is paused. Please resolve this issue first"),
+        ('Synchronize', 'paused', "Unable to export - a Sync task is paused. Resume any paused sync tasks."),
+    ]
+    for action, state, msg in checks:
+        if tasks.find(action, state):
+            helpers.log_msg(msg, 'ERROR')
+            sys.exit(-1)
 
-    check_incomplete_sync()
+    check_incomplete_sync(org_id)
 
 
-def check_incomplete_sync():
+def check_incomplete_sync(org_id):
     """
     Check for any sync tasks that are in an Incomplete state.
     These are not paused or locked, but are the orange 100% complete ones in the UI
     """
-    repo_list = helpers.get_json(
-        helpers.KATELLO_API + "/content_view_versions")
+    inventory = helpers.get_repo_inventory(org_id)
 
     # Extract the list of repo ids, then check the state of each one.
+    repo_status_list = inventory.get_status(helpers.get_cv_repo_ids())
     incomplete_sync = False
-    for repo in repo_list['results']:
-        for repo_id in repo['repositories']:
-            repo_status = helpers.get_json(
-                helpers.KATELLO_API + "/repositories/" + str(repo_id['id']))
-
-            if repo_status['content_type'] == 'puppet':
-                if repo_status['last_sync']['state'] == 'stopped':
-                    if repo_status['last_sync']['result'] == 'warning':
-                        incomplete_sync = True
-                        msg = "Repo ID " + str(repo_id['id']) + " Sync Incomplete"
-                        helpers.log_msg(msg, 'DEBUG')
+    for repo_id in sorted(repo_status_list):
+        repo_status = repo_status_list[repo_id]
+        if repo_status['content_type'] == 'puppet':
+            if repo_status['last_sync']['state'] == 'stopped':
+                if repo_status['last_sync']['result'] == 'warning':
+                    incomplete_sync = True
+                    msg = "Repo ID " + str(repo_id) + " Sync Incomplete"
+                    helpers.log_msg(msg, 'DEBUG')
 
     # If we have detected incomplete sync tasks, ask the user if they want to export anyway.
     # This isn't fatal, but *MAY* lead to inconsistent repositories on the dieconnected sat.
@@ -126,19 +129,16 @@ def locate(pattern, root=os.curdir):
 def create_tar(export_dir, export_path):
     """
     Create a TAR of the content we have exported
-    Creates a single tar, then splits into DVD size chunks and calculates
-    sha256sum for each chunk.
+    The tar is written directly into DVD size chunks, calculating the
+    sha256sum for each chunk as it is written.
     """
     today = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d')
     msg = "Creating TAR files..."
     helpers.log_msg(msg, 'INFO')
     print msg
 
-    os.chdir(export_dir)
     full_tarfile = helpers.EXPORTDIR + '/puppet_export_' + today
-    short_tarfile = 'puppet_export_' + today
-    with tarfile.open(full_tarfile, 'w') as archive:
-        archive.add(os.curdir, recursive=True)
+    helpers.write_split_tar(export_dir, full_tarfile)
 
     # Get a list of all the RPM content we are exporting
     result = [y for x in os.walk(export_dir) for y in glob(os.path.join(x[0], '*.tar.gz'))]
@@ -154,19 +154,6 @@ def create_tar(export_dir, export_path):
     os.chdir(helpers.EXPORTDIR)
     shutil.rmtree(export_path)
 
-    # Split the resulting tar into DVD size chunks & remove the original.
-    msg = "Splitting TAR file..."
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system("split -d -b 4200M " + full_tarfile + " " + full_tarfile + "_")
-    os.remove(full_tarfile)
-
-    # Temporary until pythonic method is done
-    msg = "Calculating Checksums..."
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system('sha256sum ' + short_tarfile + '_* > ' + short_tarfile + '.sha256')
-
 
 def write_timestamp(start_time):
     """
@@ -194,6 +181,22 @@ def read_timestamp():
     return last
 
 
+def read_manifest():
+    """
+    Read the checksums of the puppet repo files shipped by previous exports
+    """
+    if not os.path.exists('var/puppet_manifest.pkl'):
+        return None
+    return pickle.load(open('var/puppet_manifest.pkl', 'rb'))
+
+
+def write_manifest(manifest):
+    """
+    Save the checksums of the puppet repo files that have been shipped
+    """
+    pickle.dump(manifest, open('var/puppet_manifest.pkl', 'wb'), pickle.HIGHEST_PROTOCOL)
+
+
 def main():
     """
     Main Routine
@@ -245,6 +248,7 @@ def main():
     # If we are given a start date, use that, otherwise we need to get the last date from file
     # If there is no last export, we'll set an arbitrary start date to grab everything (2000-01-01)
     last_export = read_timestamp()
+    manifest = read_manifest()
     export_type = 'incr'
     if args.all:
         print "Performing full puppet module export"
@@ -271,10 +275,16 @@ def main():
 #    shutil.rmtree()
 
     # Check if there are any currently running tasks that will conflict with an export
-    check_running_tasks()
+    check_running_tasks(org_id)
+
+    # Incremental exports ship only the files that have changed since the last export.
+    # An export from a given date ships everything changed after that date instead.
+    shipped = None
+    if export_type == 'incr' and not since:
+        shipped = manifest
 
     # Now we have a CV ID and a starting date, and no conflicting tasks, we can export
-    export_puppet(last_export, export_type)
+    current = export_puppet(last_export, export_type, shipped)
 
     # Now we need to process the on-disk export data
     # Find the name of our export dir. This ASSUMES that the export dir is the ONLY dir.
@@ -295,6 +305,8 @@ def main():
     # We're done. Write the start timestamp to file for next time
     os.chdir(script_dir)
     write_timestamp(start_time)
+    if not since:
+        write_manifest(current)
 
     # And we're done!
     print helpers.GREEN + "Puppet module export complete.\n" + helpers.ENDC
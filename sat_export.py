@@ -10,10 +10,11 @@
 Exports Satellite 6 yum content.
 """
 
-import sys, argparse, datetime, os, shutil, pickle, re
-import fnmatch, subprocess, tarfile
+import sys, argparse, datetime, os, shutil, pickle
+import fnmatch, subprocess, multiprocessing, errno, filecmp
 import simplejson as json
 from glob import glob
+from multiprocessing.pool import ThreadPool
 import helpers
 
 try:
@@ -22,6 +23,13 @@ except ImportError:
     print "Please install the PyYAML module."
     sys.exit(-1)
 
+# Set once the incomplete sync check has been done for this run
+incomplete_checked = False
+
+# Number of RPMs to pass to each 'rpm -K' call
+GPG_BATCH = 200
+
+
 # Get details about Content Views and versions
 def get_cv(org_id):
     """
@@ -93,6 +101,9 @@ def export_cv(dov_ver, last_export, export_type):
     msg = "Export started, task_id = " + str(task_id)
     helpers.log_msg(msg, 'DEBUG')
 
+    # Our new task makes any cached task snapshot out of date
+    helpers.invalidate_cache('tasks')
+
     return str(task_id)
 
 
@@ -137,9 +148,131 @@ def export_repo(repo_id, last_export, export_type):
     msg = "Export started, task_id = " + str(task_id)
     helpers.log_msg(msg, 'DEBUG')
 
+    # Our new task makes any cached task snapshot out of date
+    helpers.invalidate_cache('tasks')
+
     return str(task_id)
 
 
+def export_repos(org_id, org_name, ename, export_jobs):
+    """
+    Export the queued repositories, running up to EXPORTBATCH export tasks at once.
+    As each export task completes a new one is started.
+    Returns the number of exported packages for each successfully exported repo label.
+    """
+    exported = {}
+    queue = list(export_jobs)
+    running = {}
+    while queue or running:
+        # Start exports until we reach our concurrency limit
+        while queue and len(running) < helpers.EXPORTBATCH:
+            job = queue.pop(0)
+            msg = job['cola'] + " " + job['colb']
+            helpers.log_msg(msg, 'INFO')
+            output = "{:<70}".format(job['cola'])
+            print output[:70] + ' ' + job['colb']
+
+            # Check if there are any currently running tasks that will conflict
+            ok_to_export = check_running_tasks(org_id, job['repo']['label'], ename)
+            if ok_to_export:
+                # Trigger export on the repo
+                task_id = export_repo(job['repo']['id'], job['last_export'], job['export_type'])
+                running[task_id] = job
+
+        if not running:
+            continue
+
+        # Wait for any of the running exports to complete
+        finished = helpers.wait_for_tasks(running.keys(), 'export')
+        for task_id in finished:
+            job = running.pop(task_id)
+            numrpms = check_repo_export(org_id, org_name, task_id, job)
+            if job.pop('retry', False):
+                queue.append(job)
+            elif numrpms is not None:
+                exported[job['repo']['label']] = numrpms
+
+    return exported
+
+
+def check_repo_export(org_id, org_name, task_id, job):
+    """
+    Check the result of a completed repository export task.
+    Returns the number of exported packages, or None if the export failed.
+    """
+    repo_result = job['repo']
+
+    # Check if the export completed OK.
+    tinfo = helpers.get_task_status(task_id)
+    if tinfo['state'] != 'running' and tinfo['result'] == 'success':
+        # Count the number of exported packages
+        # First resolve the product label - this forms part of the export path
+        product = get_product(org_id, repo_result['product']['cp_id'])
+        # Now we can build the export path itself
+        basepath = helpers.EXPORTDIR + "/" + org_name + "-" + product + "-" + repo_result['label']
+        if job['export_type'] == 'incr':
+            basepath = basepath + "-incremental"
+        exportpath = basepath + "/" + repo_result['relative_path']
+        msg = "Export path = " + exportpath
+        helpers.log_msg(msg, 'DEBUG')
+
+        # Only ship the packages that the target does not already have
+        if 'shipped' in job:
+            missing = prune_shipped(exportpath, job['packages'], job['shipped'])
+            if missing and job['export_type'] == 'incr':
+                # The 'since' export missed new content (e.g. clock drift) - export it all
+                msg = repo_result['label'] + " incremental export is missing " + \
+                    str(len(missing)) + " new packages, re-exporting in full"
+                helpers.log_msg(msg, 'WARNING')
+                print helpers.YELLOW + msg + helpers.ENDC
+                shutil.rmtree(basepath)
+                job['export_type'] = 'full'
+                job['colb'] = "(FULL)"
+                job['retry'] = True
+                return None
+            elif missing:
+                msg = repo_result['label'] + " export is missing " + str(len(missing)) + \
+                    " packages: " + ", ".join(sorted(missing)[:10])
+                helpers.log_msg(msg, 'WARNING')
+
+        numrpms = len([f for f in os.walk(exportpath).next()[2] if f[ -4: ] == ".rpm"])
+
+        msg = repo_result['label'] + " Export OK (" + str(numrpms) + " new packages)"
+        helpers.log_msg(msg, 'INFO')
+        print helpers.GREEN + msg + helpers.ENDC
+        return numrpms
+
+    msg = repo_result['label'] + " Export FAILED"
+    helpers.log_msg(msg, 'ERROR')
+    return None
+
+
+def new_packages(packages, shipped):
+    """
+    Return the filenames of the packages that have not been shipped to the target,
+    or that have changed since they were shipped.
+    """
+    return [filename for filename, checksum in packages.iteritems()
+            if filename not in shipped or shipped[filename] != checksum]
+
+
+def prune_shipped(exportpath, packages, shipped):
+    """
+    Remove the RPMs from a repository export that have already been shipped
+    to the target with the same checksum.
+    Returns the filenames of any new packages that are missing from the export.
+    """
+    present = set(f for f in os.listdir(exportpath) if f.endswith('.rpm'))
+    pruned = 0
+    for filename in present:
+        if filename in shipped and shipped[filename] == packages.get(filename):
+            os.remove(os.path.join(exportpath, filename))
+            pruned += 1
+    msg = "Removed " + str(pruned) + " previously shipped packages from " + exportpath
+    helpers.log_msg(msg, 'DEBUG')
+    return [f for f in new_packages(packages, shipped) if f not in present]
+
+
 def export_iso(repo_id, repo_label, repo_relative, last_export, export_type):
     """
     Export iso repository
@@ -171,16 +304,13 @@ def export_iso(repo_id, repo_label, repo_relative, last_export, export_type):
     # Force the status message to be shown to the user
     sys.stdout.flush()
 
+    isodirs = glob('/var/lib/pulp/published/http/isos/*' + repo_label)
     if export_type == 'full':
-        os.system('find -L /var/lib/pulp/published/http/isos/*' + repo_label \
-            + ' -type f -exec cp --parents -Lrp {} ' + ISOEXPORTDIR + " \;")
+        helpers.collect_files(isodirs, ISOEXPORTDIR)
     else:
-        os.system('find -L /var/lib/pulp/published/http/isos/*' + repo_label \
-            + ' -type f -newerct $(date +%Y-%m-%d -d "' + last_export + '") -exec cp --parents -Lrp {} ' \
-            + ISOEXPORTDIR + ' \;')
+        helpers.collect_files(isodirs, ISOEXPORTDIR, since=last_export)
         # We need to copy the manifest anyway, otherwise we'll cause import issues if we have an empty repo
-        os.system('find -L /var/lib/pulp/published/http/isos/*' + repo_label \
-            + ' -name PULP_MANIFEST -exec cp --parents -Lrp {} ' + ISOEXPORTDIR + ' \;')
+        helpers.collect_files(isodirs, ISOEXPORTDIR, pattern='PULP_MANIFEST')
 
 
     # At this point the iso/ export dir will contain individual repos - we need to 'normalise' them
@@ -209,92 +339,62 @@ def export_iso(repo_id, repo_label, repo_relative, last_export, export_type):
 
 
 
-def check_running_tasks(label, name):
+def check_running_tasks(org_id, label, name):
     """
     Check for any currently running Sync or Export tasks
     Exits script if any Synchronize or Export tasks are found in a running state.
     """
     #pylint: disable-msg=R0912,R0914,R0915
-    tasks = helpers.get_p_json(
-        helpers.FOREMAN_API + "tasks/", \
-                json.dumps(
-                    {
-                        "per_page": "100",
-                    }
-                ))
-
-    # From the list of tasks, look for any running export or sync jobs.
+    tasks = helpers.get_task_snapshot()
+
+    # From the list of tasks, look for any running export or sync jobs on this repo.
     # If e have any we exit, as we can't export in this state.
+    checks = [
+        ('Export', 'running', "Unable to export due to export task in progress"),
+        ('Synchronize', 'running', "Unable to export due to sync task in progress"),
+        ('Export', 'paused', "Unable to export due to paused export task - Please resolve this issue."),
+        ('Synchronize', 'paused', "Unable to export due to paused sync task."),
+    ]
     ok_to_export = True
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running':
-            if task_result['humanized']['action'] == 'Export':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to export task in progress"
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(-1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
-            if task_result['humanized']['action'] == 'Synchronize':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to sync task in progress"
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(-1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
-        if task_result['state'] == 'paused':
-            if task_result['humanized']['action'] == 'Export':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to paused export task - Please resolve this issue."
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(-1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
-            if task_result['humanized']['action'] == 'Synchronize':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to paused sync task."
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(-1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
+    for action, state, msg in checks:
+        if tasks.find(action, state, label=label):
+            if name == 'DoV':
+                helpers.log_msg(msg, 'ERROR')
+                sys.exit(-1)
+            else:
+                helpers.log_msg(msg, 'WARNING')
+                ok_to_export = False
 
-    check_incomplete_sync()
+    # The incomplete sync check only needs to be done once per export run
+    global incomplete_checked
+    if not incomplete_checked:
+        check_incomplete_sync(org_id)
+        incomplete_checked = True
     return ok_to_export
 
 
-def check_incomplete_sync():
+def check_incomplete_sync(org_id):
     """
     Check for any sync tasks that are in an Incomplete state.
     These are not paused or locked, but are the orange 100% complete ones in the UI
     """
-    repo_list = helpers.get_json(
-        helpers.KATELLO_API + "/content_view_versions")
+    inventory = helpers.get_repo_inventory(org_id)
 
     # Extract the list of repo ids, then check the state of each one.
+    repo_status_list = inventory.get_status(helpers.get_cv_repo_ids())
     incomplete_sync = False
-    for repo in repo_list['results']:
-        for repo_id in repo['repositories']:
-            repo_status = helpers.get_json(
-                helpers.KATELLO_API + "/repositories/" + str(repo_id['id']))
-
-            if repo_status['content_type'] == 'yum':
-                if repo_status['last_sync'] is None:
-                    if repo_status['url'] is None:
-                        msg = "Repo ID " + str(repo_id['id']) + " No Sync Configured"
-                        #helpers.log_msg(msg, 'DEBUG')
-                elif repo_status['last_sync']['state'] == 'stopped':
-                    if repo_status['last_sync']['result'] == 'warning':
-                        incomplete_sync = True
-                        msg = "Repo ID " + str(repo_id['id']) + " Sync Incomplete"
-                        helpers.log_msg(msg, 'DEBUG')
+    for repo_id in sorted(repo_status_list):
+        repo_status = repo_status_list[repo_id]
+        if repo_status['content_type'] == 'yum':
+            if repo_status['last_sync'] is None:
+                if repo_status['url'] is None:
+                    msg = "Repo ID " + str(repo_id) + " No Sync Configured"
+                    #helpers.log_msg(msg, 'DEBUG')
+            elif repo_status['last_sync']['state'] == 'stopped':
+                if repo_status['last_sync']['result'] == 'warning':
+                    incomplete_sync = True
+                    msg = "Repo ID " + str(repo_id) + " Sync Incomplete"
+                    helpers.log_msg(msg, 'DEBUG')
 
     # If we have detected incomplete sync tasks, ask the user if they want to export anyway.
     # This isn't fatal, but *MAY* lead to inconsistent repositories on the dieconnected sat.
@@ -331,9 +431,29 @@ def locate(pattern, root=os.curdir):
             yield os.path.join(path, filename)
 
 
+def gpg_check_batch(rpms):
+    """
+    Run a single 'rpm -K' on a batch of RPM files and parse the result for each.
+    Returns the list of RPMs that failed the GPG check.
+    """
+    proc = subprocess.Popen(['rpm', '-K'] + rpms, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+
+    # Each good package is reported as '<file>: <digests> OK'
+    passed = set()
+    for line in output.splitlines():
+        rpm, sep, result = line.partition(': ')
+        if sep and result.rstrip().endswith('OK') and 'NOT OK' not in result:
+            passed.add(rpm)
+    return [rpm for rpm in rpms if rpm not in passed]
+
+
 def do_gpg_check(export_dir):
     """
     Find and GPG Check all RPM files
+    RPMs that passed in a previous export and have not changed since are skipped.
+    The remaining RPMs are checked in batches, with a batch running on each CPU.
     """
     msg = "Checking GPG integrity of exported RPMs..."
     helpers.log_msg(msg, 'INFO')
@@ -343,29 +463,65 @@ def do_gpg_check(export_dir):
     sys.stdout.flush()
 
     badrpms = []
+    failedrpms = set()
     os.chdir(export_dir)
-    for rpm in locate("*.rpm"):
-        return_code = subprocess.call("rpm -K " + rpm, shell=True, stdout=open(os.devnull, 'wb'))
+    rpms = list(locate("*.rpm"))
+
+    # Skip any RPMs that have already been verified
+    cache = helpers.GpgCache(vardir)
+    verified = cache.get_verified()
+    rpm_keys = {}
+    cached = []
+    to_check = []
+    for rpm in rpms:
+        stat = os.stat(rpm)
+        path = os.path.relpath(rpm, export_dir)
+        rpm_keys[rpm] = (path, stat.st_size, int(stat.st_mtime))
+        if verified.get(path) == (stat.st_size, int(stat.st_mtime)):
+            cached.append(path)
+        else:
+            to_check.append(rpm)
+    cache.mark_seen(cached)
+    msg = str(len(cached)) + " RPMs previously verified, " + str(len(to_check)) + " to check"
+    helpers.log_msg(msg, 'DEBUG')
 
-        # A non-zero return code indicates a GPG check failure.
-        if return_code != 0:
-            # For display purposes, strip the first 6 directory elements
-            rpmnew = os.path.join(*(rpm.split(os.path.sep)[6:]))
-            badrpms.append(rpmnew)
+    batches = [to_check[i:i + GPG_BATCH] for i in range(0, len(to_check), GPG_BATCH)]
+    pool = ThreadPool(multiprocessing.cpu_count())
+    try:
+        checked = 0
+        for failed in pool.imap_unordered(gpg_check_batch, batches):
+            # A failed package is one not reported as OK
+            for rpm in failed:
+                failedrpms.add(rpm)
+                # For display purposes, strip the first 6 directory elements
+                rpmnew = os.path.join(*(rpm.split(os.path.sep)[6:]))
+                badrpms.append(rpmnew)
+            checked += GPG_BATCH
+            sys.stdout.write('\r' + output[:70] + ' ' + str(min(checked, len(to_check))) \
+                + '/' + str(len(to_check)))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.write('\r' + ' ' * 100 + '\r' + output[:70] + ' ')
+
+    # Record the newly verified RPMs for next time
+    cache.add_verified([rpm_keys[rpm] for rpm in to_check if rpm not in failedrpms])
+    cache.close()
 
     # If we have any bad ones we need to fail the export.
     if len(badrpms) != 0:
         print helpers.RED + "GPG Check FAILED" + helpers.ENDC
         msg = "The following RPM's failed the GPG check.."
         helpers.log_msg(msg, 'ERROR')
-        for badone in badrpms:
+        for badone in sorted(badrpms):
             msg = badone
             helpers.log_msg(msg, 'ERROR')
         msg = "------ Export Aborted ------"
         helpers.log_msg(msg, 'INFO')
         sys.exit(-1)
     else:
-        msg = "GPG check completed successfully"
+        msg = "GPG check completed successfully (" + str(len(rpms)) + " RPMs)"
         helpers.log_msg(msg, 'INFO')
         print helpers.GREEN + "GPG Check - Pass" + helpers.ENDC
 
@@ -373,19 +529,16 @@ def do_gpg_check(export_dir):
 def create_tar(export_dir, name):
     """
     Create a TAR of the content we have exported
-    Creates a single tar, then splits into DVD size chunks and calculates
-    sha256sum for each chunk.
+    The tar is written directly into DVD size chunks, calculating the
+    sha256sum for each chunk as it is written.
     """
     today = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d')
     msg = "Creating TAR files..."
     helpers.log_msg(msg, 'INFO')
     print msg
 
-    os.chdir(export_dir)
     full_tarfile = helpers.EXPORTDIR + '/sat6_export_' + today + '_' + name
-    short_tarfile = 'sat6_export_' + today + '_' + name
-    with tarfile.open(full_tarfile, 'w') as archive:
-        archive.add(os.curdir, recursive=True)
+    helpers.write_split_tar(export_dir, full_tarfile)
 
     # Get a list of all the RPM content we are exporting
     result = [y for x in os.walk(export_dir) for y in glob(os.path.join(x[0], '*.rpm'))]
@@ -403,19 +556,6 @@ def create_tar(export_dir, name):
     if os.path.exists(helpers.EXPORTDIR + "/iso"):
         shutil.rmtree(helpers.EXPORTDIR + "/iso")
 
-    # Split the resulting tar into DVD size chunks & remove the original.
-    msg = "Splitting TAR file..."
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system("split -d -b 4200M " + full_tarfile + " " + full_tarfile + "_")
-    os.remove(full_tarfile)
-
-    # Temporary until pythonic method is done
-    msg = "Calculating Checksums..."
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system('sha256sum ' + short_tarfile + '_* > ' + short_tarfile + '.sha256')
-
 
 def prep_export_tree(org_name):
     """
@@ -426,42 +566,170 @@ def prep_export_tree(org_name):
     msg = "Preparing export directory tree..."
     helpers.log_msg(msg, 'INFO')
     print msg
-    devnull = open(os.devnull, 'wb')
     if not os.path.exists(helpers.EXPORTDIR + "/export"):
         os.makedirs(helpers.EXPORTDIR + "/export")
-    # Haven't found a nice python way to do this - yet...
-    subprocess.call("cp -rp " + helpers.EXPORTDIR + "/" + org_name + "*/" + org_name + \
-        "/Library/* " + helpers.EXPORTDIR + "/export", shell=True, stdout=devnull, stderr=devnull)
+
+    # Anything already in the export tree (ISO repos) does not have listing files yet
+    touched = set()
+    # pylint: disable=unused-variable
+    for root, directories, filenames in os.walk(helpers.EXPORTDIR + "/export"):
+        touched.add(root)
+
+    # Move the content of each repo export into the combined tree
+    conflicts = []
+    for srcdir in sorted(glob(helpers.EXPORTDIR + "/" + org_name + "*/" + org_name + "/Library")):
+        conflicts.extend(merge_tree(srcdir, helpers.EXPORTDIR + "/export", touched))
+    for conflict in conflicts:
+        msg = "Conflicting file in export tree (replaced): " + conflict
+        helpers.log_msg(msg, 'WARNING')
+
     # Remove original directores
-    os.system("rm -rf " + helpers.EXPORTDIR + "/" + org_name + "*/")
+    for srcdir in glob(helpers.EXPORTDIR + "/" + org_name + "*/"):
+        shutil.rmtree(srcdir)
 
-    # We need to re-generate the 'listing' files as we will have overwritten some during the merge
+    # We need to re-generate the 'listing' files in directories changed by the merge
     msg = "Rebuilding listing files..."
     helpers.log_msg(msg, 'INFO')
     print msg
-    create_listing_file(helpers.EXPORTDIR + "/export")
+    update_listing_files(touched)
 
-    # pylint: disable=unused-variable
-    for root, directories, filenames in os.walk(helpers.EXPORTDIR + "/export"):
-        for subdir in directories:
-            currentdir = os.path.join(root, subdir)
-            create_listing_file(currentdir)
+
+def move_file(src, dest):
+    """
+    Move a file into place. Files on the same filesystem are simply renamed,
+    otherwise a reflink copy is made where supported, falling back to a full copy.
+    """
+    try:
+        os.rename(src, dest)
+        return
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+    devnull = open(os.devnull, 'wb')
+    if subprocess.call(['cp', '--reflink=auto', '-p', src, dest], stdout=devnull,
+            stderr=devnull) != 0:
+        shutil.copy2(src, dest)
+    os.remove(src)
 
 
-def get_immediate_subdirectories(a_dir):
-    """ Return a list of subdirectories """
-    return [name for name in os.listdir(a_dir) if os.path.isdir(os.path.join(a_dir, name))]
+def merge_tree(srcdir, destdir, touched):
+    """
+    Merge the content of srcdir into destdir, moving entries rather than copying them.
+    Directories that do not yet exist in destdir are moved across whole.
+    Any directory whose 'listing' file is now out of date is added to 'touched'.
+    Returns a list of files that existed in both trees with different content -
+    the file from srcdir replaces the existing one, as 'cp' would.
+    """
+    conflicts = []
+    for name in sorted(os.listdir(srcdir)):
+        src = os.path.join(srcdir, name)
+        dest = os.path.join(destdir, name)
+        if os.path.isdir(src) and not os.path.islink(src):
+            if not os.path.exists(dest):
+                # A new subdirectory - the listing of destdir needs to include it
+                touched.add(destdir)
+                try:
+                    os.rename(src, dest)
+                    continue
+                except OSError, e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                os.makedirs(dest)
+                touched.add(dest)
+            conflicts.extend(merge_tree(src, dest, touched))
+        else:
+            if os.path.exists(dest):
+                if filecmp.cmp(src, dest, shallow=False):
+                    os.remove(src)
+                    continue
+                if name == 'listing':
+                    touched.add(destdir)
+                else:
+                    conflicts.append(dest)
+                os.remove(dest)
+            move_file(src, dest)
+    return conflicts
 
 
-def create_listing_file(directory):
+def update_listing_files(directories):
     """
-    Function to create the listing file containing the subdirectories
+    Re-generate the 'listing' file containing the subdirectories of each of
+    the given directories. Directories are processed deepest first, and listing
+    files that are already correct are left alone.
     """
-    listing_file = open(directory + "/listing", "w")
-    sorted_subdirs = sorted(get_immediate_subdirectories(directory))
-    for directory in sorted_subdirs:
-        listing_file.write(directory + "\n")
-    listing_file.close()
+    for directory in sorted(directories, key=lambda d: d.count(os.sep), reverse=True):
+        subdirs = sorted(name for name, path, is_dir in helpers.list_dir(directory) if is_dir)
+        content = ''.join(subdir + "\n" for subdir in subdirs)
+        listing = os.path.join(directory, "listing")
+        if os.path.exists(listing):
+            with open(listing, "r") as listing_file:
+                if listing_file.read() == content:
+                    continue
+        with open(listing, "w") as listing_file:
+            listing_file.write(content)
+
+
+def dedupe_export_tree(export_dir):
+    """
+    Replace files in the export tree that have identical content with hardlinks
+    to a single copy, so that the tar stores the content once and the duplicates
+    as hardlink members. Only files of the same size are checksummed.
+    Returns the number of bytes saved.
+    """
+    msg = "Deduplicating export content..."
+    helpers.log_msg(msg, 'INFO')
+    print msg
+
+    # Group candidate files by size - a file with a unique size has no duplicate
+    by_size = {}
+    # pylint: disable=unused-variable
+    for root, directories, filenames in os.walk(export_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            # Listing files are rewritten in place, so must never be shared
+            if filename == 'listing' or os.path.islink(path):
+                continue
+            stat = os.stat(path)
+            if stat.st_size:
+                by_size.setdefault(stat.st_size, []).append((path, (stat.st_dev, stat.st_ino)))
+
+    # Files that are already hardlinked together only need checksumming once
+    candidates = {}
+    for size, files in by_size.items():
+        inodes = set(inode for path, inode in files)
+        if len(inodes) > 1:
+            for path, inode in files:
+                candidates.setdefault(inode, path)
+    paths = sorted(candidates.values())
+    digests = dict(zip(paths, helpers.parallel_map(
+        lambda path: helpers.file_digests(path)['sha256'], paths)))
+
+    numfiles = 0
+    saved = 0
+    for size, files in sorted(by_size.items()):
+        first = {}
+        for path, inode in sorted(files):
+            digest = digests.get(candidates.get(inode))
+            if digest is None:
+                continue
+            if digest not in first:
+                first[digest] = (path, inode)
+                continue
+            orig, orig_inode = first[digest]
+            if inode == orig_inode:
+                continue
+            # Link alongside the duplicate then rename over it, so the path is never missing
+            tmpfile = path + '.dedupe'
+            os.link(orig, tmpfile)
+            os.rename(tmpfile, path)
+            numfiles += 1
+            saved += size
+
+    msg = "Deduplicated " + str(numfiles) + " files, saving " + \
+        str(round(saved / 1048576.0, 1)) + " MB"
+    helpers.log_msg(msg, 'INFO')
+    print msg
+    return saved
 
 
 def read_pickle(name):
@@ -479,20 +747,33 @@ def read_pickle(name):
     return export_times
 
 
+def read_manifest(name):
+    """
+    Function to read the record of the packages shipped to the target by previous
+    exports. Returns a dict of {repo_label: {package filename: checksum}}
+    """
+    if not os.path.exists(vardir + '/manifest_' + name + '.pkl'):
+        return {}
+    return pickle.load(open(vardir + '/manifest_' + name + '.pkl', 'rb'))
+
+
+def write_manifest(name, manifest):
+    """
+    Function to save the record of the packages shipped to the target
+    """
+    pickle.dump(manifest, open(vardir + '/manifest_' + name + '.pkl', 'wb'),
+        pickle.HIGHEST_PROTOCOL)
+
+
 def get_product(org_id, cp_id):
     """
     Find and return the label of the given product ID
     """
-    prod_list = helpers.get_p_json(
-        helpers.KATELLO_API + "/products/", \
-                json.dumps(
-                        {
-                           "organization_id": org_id,
-                           "per_page": '1000',
-                        }
-                ))
+    prod_list = helpers.cache_get(('products', org_id),
+        lambda: helpers.get_all_results(helpers.KATELLO_API + "/products/",
+            {"organization_id": org_id}))
 
-    for prod in prod_list['results']:
+    for prod in prod_list:
         if prod['cp_id'] == cp_id:
             prodlabel = prod['label']
             return prodlabel
@@ -516,7 +797,7 @@ def main(args):
     global dir 
     global vardir 
     dir = os.path.dirname(__file__)
-    vardir = os.path.join(dir, 'var')
+    vardir = os.path.join(os.path.abspath(dir), 'var')
 
     # Log the fact we are starting
     msg = "------------- Content export started by " + runuser + " ----------------"
@@ -583,6 +864,8 @@ def main(args):
 
     # Read the last export date pickle for our selected repo group.
     export_times = read_pickle(ename)
+    manifest = read_manifest(ename)
+    shipped_packages = {}
     export_type = 'incr'
 
     if args.all:
@@ -624,14 +907,7 @@ def main(args):
     # Collect a list of enabled repositories. This is needed for:
     # 1. Matching specific repo exports, and
     # 2. Running import sync per repo on the disconnected side
-    repolist = helpers.get_p_json(
-        helpers.KATELLO_API + "/repositories/", \
-                json.dumps(
-                        {
-                           "organization_id": org_id,
-                           "per_page": '1000',
-                        }
-                ))
+    repolist = helpers.get_repo_inventory(org_id)
 
     # If we are running a full DoV export we run a different set of API calls...
     if ename == 'DoV':
@@ -651,7 +927,7 @@ def main(args):
         print output[:70] + ' ' + colb
 
         # Check if there are any currently running tasks that will conflict with an export
-        check_running_tasks(label, ename)
+        check_running_tasks(org_id, label, ename)
 
         # Get the version of the CV (Default Org View) to export
         dov_ver = get_cv(org_id)
@@ -673,7 +949,7 @@ def main(args):
             export_times['DoV'] = start_time
 
             # Generate a list of repositories that were exported
-            for repo_result in repolist['results']:
+            for repo_result in repolist.results:
                 if repo_result['content_type'] == 'yum':
                     # Add the repo to the successfully exported list
                     exported_repos.append(repo_result['label'])
@@ -685,87 +961,38 @@ def main(args):
 
     else:
         # Verify that defined repos exist in Satellite
+        labels = repolist.get_label_index()
         for repo in erepos:
-            repo_in_sat = False
-            for repo_x in repolist['results']:
-                if re.findall("\\b" + repo + "\\b$", repo_x['label']):
-                    repo_in_sat = True
-                    break
-            if repo_in_sat == False:
+            if not labels.find(repo):
                 msg = "'" + repo + "' not found in Satellite"
                 helpers.log_msg(msg, 'WARNING')
 
-        # Process each repo
-        for repo_result in repolist['results']:
+        # Process each repo. Yum repos are queued up to be exported in parallel.
+        erepo_set = set(erepos)
+        export_jobs = []
+        for repo_result in repolist.results:
             if repo_result['content_type'] == 'yum':
-                # If we have a match, do the export
-                if repo_result['label'] in erepos:
+                # If we have a match, queue the export
+                if repo_result['label'] in erepo_set:
                     # Extract the last export time for this repo
-                    orig_export_type = export_type
                     cola = "Export " + repo_result['label']
                     if export_type == 'incr' and repo_result['label'] in export_times:
+                        repo_export_type = 'incr'
                         last_export = export_times[repo_result['label']]
                         if since:
                             last_export = since_export
                         colb = "(INCR since " + last_export + ")"
                     else:
-                        export_type = 'full'
+                        repo_export_type = 'full'
                         last_export = '2000-01-01 12:00:00' # This is a dummy value, never used.
                         colb = "(FULL)"
-                    msg = cola + " " + colb
-                    helpers.log_msg(msg, 'INFO')
-                    output = "{:<70}".format(cola)
-                    print output[:70] + ' ' + colb
-
-                    # Check if there are any currently running tasks that will conflict
-                    ok_to_export = check_running_tasks(repo_result['label'], ename)
-
-                    if ok_to_export:
-                        # Trigger export on the repo
-                        export_id = export_repo(repo_result['id'], last_export, export_type)
-
-                        # Now we need to wait for the export to complete
-                        helpers.wait_for_task(export_id, 'export')
-
-                        # Check if the export completed OK. If not we exit the script.
-                        tinfo = helpers.get_task_status(export_id)
-                        if tinfo['state'] != 'running' and tinfo['result'] == 'success':
-                            # Count the number of exported packages
-                            # First resolve the product label - this forms part of the export path
-                            product = get_product(org_id, repo_result['product']['cp_id'])
-                            # Now we can build the export path itself
-                            basepath = helpers.EXPORTDIR + "/" + org_name + "-" + product + "-" + repo_result['label']
-                            if export_type == 'incr':
-                                basepath = basepath + "-incremental"
-                            exportpath = basepath + "/" + repo_result['relative_path']
-                            msg = "\nExport path = " + exportpath
-                            helpers.log_msg(msg, 'DEBUG')
-
-                            os.chdir(exportpath)
-                            numrpms = len([f for f in os.walk(".").next()[2] if f[ -4: ] == ".rpm"])
-
-                            msg = "Repository Export OK (" + str(numrpms) + " new packages)"
-                            helpers.log_msg(msg, 'INFO')
-                            print helpers.GREEN + msg + helpers.ENDC
-
-                            # Update the export timestamp for this repo
-                            export_times[repo_result['label']] = start_time
-
-                            # Add the repo to the successfully exported list
-                            if numrpms != 0 or args.repodata:
-                                msg = "Adding " + repo_result['label'] + " to export list"
-                                helpers.log_msg(msg, 'DEBUG')
-                                exported_repos.append(repo_result['label'])
-                            else:
-                                msg = "Not including repodata for empty repo " + repo_result['label']
-                                helpers.log_msg(msg, 'DEBUG')
-
-                        else:
-                            msg = "Export FAILED"
-                            helpers.log_msg(msg, 'ERROR')
-
-                        # Reset the export type to the user specified, in case we overrode it.
-                        export_type = orig_export_type
+                    export_jobs.append({
+                        'repo': repo_result,
+                        'last_export': last_export,
+                        'export_type': repo_export_type,
+                        'cola': cola,
+                        'colb': colb,
+                    })
 
                 else:
                     msg = "Skipping  " + repo_result['label']
@@ -774,7 +1001,7 @@ def main(args):
             # Handle FILE type exports (ISO repos)
             elif repo_result['content_type'] == 'file':
                 # If we have a match, do the export
-                if repo_result['label'] in erepos:
+                if repo_result['label'] in erepo_set:
                     # Extract the last export time for this repo
                     orig_export_type = export_type
                     cola = "Export " + repo_result['label']
@@ -793,7 +1020,7 @@ def main(args):
                     print output[:70] + ' ' + colb
 
                     # Check if there are any currently running tasks that will conflict
-                    ok_to_export = check_running_tasks(repo_result['label'], ename)
+                    ok_to_export = check_running_tasks(org_id, repo_result['label'], ename)
 
                     if ok_to_export:
                         # Trigger export on the repo
@@ -818,6 +1045,46 @@ def main(args):
                     msg = "Skipping  " + repo_result['label']
                     helpers.log_msg(msg, 'DEBUG')
 
+        # Compare the current content of each repo with what the target already has,
+        # so that only new packages are shipped. An export from a given date ('since')
+        # ships everything changed after that date instead.
+        if not since:
+            packages = helpers.parallel_map(
+                lambda job: helpers.get_repo_packages(job['repo']['id']), export_jobs)
+            for job, repo_packages in zip(list(export_jobs), packages):
+                label = job['repo']['label']
+                job['packages'] = repo_packages
+                if job['export_type'] != 'incr' or label not in manifest:
+                    continue
+                job['shipped'] = manifest[label]
+                numnew = len(new_packages(repo_packages, job['shipped']))
+                job['colb'] = "(INCR - " + str(numnew) + " new packages)"
+                if repo_packages == job['shipped'] and not args.repodata:
+                    msg = "No new content for " + label + ", skipping export"
+                    helpers.log_msg(msg, 'INFO')
+                    output = "{:<70}".format(job['cola'])
+                    print output[:70] + ' (No new content)'
+                    export_times[label] = start_time
+                    export_jobs.remove(job)
+
+        # Run the queued yum repo exports
+        exported = export_repos(org_id, org_name, ename, export_jobs)
+        for job in export_jobs:
+            label = job['repo']['label']
+            if label in exported:
+                # Update the export timestamp for this repo
+                export_times[label] = start_time
+                if 'packages' in job:
+                    shipped_packages[label] = job['packages']
+
+                # Add the repo to the successfully exported list
+                if exported[label] != 0 or args.repodata:
+                    msg = "Adding " + label + " to export list"
+                    helpers.log_msg(msg, 'DEBUG')
+                    exported_repos.append(label)
+                else:
+                    msg = "Not including repodata for empty repo " + label
+                    helpers.log_msg(msg, 'DEBUG')
 
 
     # Combine resulting directory structures into a single repo format (top level = /content)
@@ -835,12 +1102,19 @@ def main(args):
     if not args.nogpg:
         do_gpg_check(export_dir)
 
+    # Store identical files in the export only once
+    dedupe_export_tree(export_dir)
+
     # Add our exported data to a tarfile
     create_tar(export_dir, ename)
 
     # We're done. Write the start timestamp to file for next time
     os.chdir(script_dir)
     pickle.dump(export_times, open(vardir + '/exports_' + ename + '.pkl', "wb"))
+    # The target now has the packages of each repo we exported
+    if shipped_packages:
+        manifest.update(shipped_packages)
+        write_manifest(ename, manifest)
 
     # And we're done!
     print helpers.GREEN + "Export complete.\n" + helpers.ENDC
@@ -10,15 +10,19 @@
 Imports Satellite 6 yum content exported by sat_export.py
 """
 
-import sys, argparse, os, pickle
+import sys, argparse, os, pickle, time, tarfile
 import simplejson as json
 import helpers
 
+# Checksum algorithm of a package checksum, identified by its length
+CHECKSUM_TYPES = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
 
-def get_inputfiles(expdate):
+
+def get_inputfiles(expdate, verify):
     """
     Verify the input files exist and are valid.
     'expdate' is a date (YYYY-MM-DD) provided by the user - date is in the filename of the archive
+    'verify' requests that all checksums are verified up front, before extraction
     Returned 'basename' is the full export filename (sat6_export_YYYY-MM-DD)
     """
     basename = 'sat6_export_' + expdate
@@ -28,79 +32,247 @@ def get_inputfiles(expdate):
         helpers.log_msg(msg, 'ERROR')
         sys.exit(-1)
 
-    # Verify the checksum of each part of the import
+    # Verify that each part of the import is present. The checksums of each part
+    # are verified as the content is extracted.
     os.chdir(helpers.IMPORTDIR)
-    msg = 'Verifying Checksums in ' + helpers.IMPORTDIR + '/' + shafile
+    chunks = helpers.read_sha256_manifest(shafile)
+    for chunkname, digest in chunks:
+        if not os.path.exists(chunkname):
+            msg = "Cannot continue - missing archive file " + helpers.IMPORTDIR + '/' + chunkname
+            helpers.log_msg(msg, 'ERROR')
+            sys.exit(-1)
+
+    # If requested, verify the checksum of every part before we extract anything
+    if verify:
+        msg = 'Verifying Checksums in ' + helpers.IMPORTDIR + '/' + shafile
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        if not helpers.verify_chunks(chunks):
+            msg = "Import Aborted - Tarfile checksum verification failed"
+            helpers.log_msg(msg, 'ERROR')
+            sys.exit(-1)
+
+        # We're good
+        msg = "Tarfile checksum verification passed"
+        helpers.log_msg(msg, 'INFO')
+        print helpers.GREEN + "Checksum verification - Pass" + helpers.ENDC
+
+    return basename
+
+
+def safe_members(archive):
+    """
+    Return the members of the tar archive, skipping any that would be
+    extracted outside of the current directory
+    """
+    for member in archive:
+        names = [member.name]
+        if member.islnk():
+            # Hardlinks to duplicate content must also point inside the archive
+            names.append(member.linkname)
+        if [name for name in names if name.startswith('/') or '..' in name.split('/')]:
+            msg = "Skipping unsafe archive member " + member.name
+            helpers.log_msg(msg, 'WARNING')
+            continue
+        yield member
+
+
+def extract_content(basename):
+    """
+    Extract the tar archive
+    The parts of the archive are read in order as a single stream, and the
+    checksum of each part is verified as it is read.
+    """
+    os.chdir(helpers.IMPORTDIR)
+
+    msg = "Verifying Checksums and extracting tarfiles"
     helpers.log_msg(msg, 'INFO')
     print msg
-    result = os.system('sha256sum -c ' + shafile)
-
-    # Return code from sha256sum is 0 if all is fine.
-    if result != 0:
-        msg = "Import Aborted - Tarfile checksum verification failed"
+    reader = helpers.ChunkReader(helpers.read_sha256_manifest(basename + '.sha256'))
+    start = time.time()
+    try:
+        # The archive may have been compressed by sat_export
+        stream = helpers.DecompressReader(reader)
+        if stream.method != 'none':
+            msg = "Archive is " + stream.method + " compressed"
+            helpers.log_msg(msg, 'INFO')
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            archive.extractall(members=safe_members(archive))
+        reader.finish()
+    except (IOError, tarfile.TarError), e:
+        msg = "Import Aborted - " + str(e)
         helpers.log_msg(msg, 'ERROR')
         sys.exit(-1)
 
     # We're good
+    elapsed = max(time.time() - start, 0.001)
     msg = "Tarfile checksum verification passed"
     helpers.log_msg(msg, 'INFO')
     print helpers.GREEN + "Checksum verification - Pass" + helpers.ENDC
+    msg = "Extracted " + str(reader.total / (1024 * 1024)) + " MB in " + str(int(elapsed)) \
+        + "s (" + str(round(reader.total / elapsed / (1024 * 1024), 1)) + " MB/s)"
+    helpers.log_msg(msg, 'INFO')
+    print msg
 
-    return basename
 
+def check_new_content(repos, prune):
+    """
+    Compare the extracted packages of each yum repo with an index of the packages
+    already in the repo in Satellite. Packages that are already present with the
+    same checksum are reported, and removed from the extracted tree if 'prune' is set.
+    Returns the number of new packages for each repo id.
+    """
+    yum_repos = [repo for repo in repos if repo['content_type'] == 'yum']
+    indexes = helpers.parallel_map(lambda repo: helpers.get_repo_packages(repo['id']), yum_repos)
+
+    new_content = {}
+    for repo, index in zip(yum_repos, indexes):
+        # The extracted repo is the relative path without the leading '<org>/Library'
+        repodir = os.path.join(helpers.IMPORTDIR, *repo['relative_path'].strip('/').split('/')[2:])
+        if not os.path.isdir(repodir):
+            new_content[repo['id']] = 0
+            continue
+        rpms = [f for f in os.listdir(repodir) if f.endswith('.rpm')]
+
+        def checksum(filename):
+            """ Checksum an extracted package with the algorithm used by Satellite """
+            algorithm = CHECKSUM_TYPES[len(index[filename])]
+            return helpers.file_digests(os.path.join(repodir, filename), (algorithm,))[algorithm]
+
+        # A package is only redundant if its content matches the one in Satellite
+        candidates = [f for f in rpms if index.get(f) and len(index[f]) in CHECKSUM_TYPES]
+        digests = helpers.parallel_map(checksum, candidates)
+        redundant = [f for f, digest in zip(candidates, digests) if digest == index[f].lower()]
+
+        new_content[repo['id']] = len(rpms) - len(redundant)
+        msg = "Repo " + repo['label'] + ": " + str(new_content[repo['id']]) + \
+            " new packages, " + str(len(redundant)) + " already present"
+        helpers.log_msg(msg, 'INFO')
+        if prune and redundant:
+            for filename in redundant:
+                os.remove(os.path.join(repodir, filename))
+            msg = "Removed " + str(len(redundant)) + " packages already present in " + \
+                repo['label']
+            helpers.log_msg(msg, 'INFO')
 
-def extract_content(basename):
+    return new_content
+
+
+def sync_repos(repos_to_sync, repo_details):
     """
-    Extract the tar archive
+    Sync the given repository ids in order, running up to SYNCBATCH sync tasks at once.
+    As each sync task completes a new one is started.
+    Returns the sync duration in seconds of each successfully synced repo label.
     """
-    os.chdir(helpers.IMPORTDIR)
+    durations = {}
+    queue = list(repos_to_sync)
+    running = {}
+    while queue or running:
+        # Start syncs until we reach our concurrency limit
+        while queue and len(running) < helpers.SYNCBATCH:
+            repo_id = queue.pop(0)
+            msg = "Syncing repo " + repo_details[repo_id]['label']
+            helpers.log_msg(msg, 'INFO')
+            print msg
+            task_id = helpers.post_json(
+                helpers.KATELLO_API + "repositories/" + str(repo_id) + "/sync", \
+                    json.dumps(
+                        {
+                        }
+                    ))["id"]
+            msg = "Repo sync task id = " + task_id
+            helpers.log_msg(msg, 'DEBUG')
+            running[task_id] = (repo_id, time.time())
+
+        # Wait for any of the running syncs to complete
+        finished = helpers.wait_for_tasks(running.keys(), 'sync')
+        for task_id, tinfo in finished.items():
+            (repo_id, started) = running.pop(task_id)
+            label = repo_details[repo_id]['label']
+            if tinfo['state'] != 'running' and tinfo.get('result') == 'success':
+                durations[label] = time.time() - started
+                msg = "Repo " + label + " sync complete (" + str(int(durations[label])) + "s)"
+                helpers.log_msg(msg, 'INFO')
+                print helpers.GREEN + msg + helpers.ENDC
+            else:
+                msg = "Repo " + label + " sync has errors"
+                helpers.log_msg(msg, 'WARNING')
 
-    # Extract the archives (Using OS call for this at the moment)
-    msg = "Extracting tarfiles"
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system('cat ' + basename + '_* | tar xpf -')
+    return durations
 
 
-def sync_content(org_id, imported_repos):
+def read_sync_times():
     """
-    Synchronize the repositories
-    Triggers a sync of all repositories belonging to the configured sync plan
+    Read the duration of the last sync of each repo from the previous imports
     """
-    repos_to_sync = []
-    delete_override = False
+    if not os.path.exists(vardir + '/sync_times.pkl'):
+        return {}
+    return pickle.load(open(vardir + '/sync_times.pkl', 'rb'))
 
-    # Get a listing of repositories in this Satellite
-    enabled_repos = helpers.get_p_json(
-        helpers.KATELLO_API + "/repositories/", \
+
+def write_sync_times(sync_times):
+    """
+    Save the duration of the last sync of each repo
+    """
+    if not os.path.exists(vardir):
+        os.makedirs(vardir)
+    pickle.dump(sync_times, open(vardir + '/sync_times.pkl', 'wb'))
+
+
+def set_mirror_on_sync(repo_id):
+    """
+    Set the mirror-on-sync flag of a repository to FALSE
+    """
+    msg = "Setting mirror-on-sync=false for repo id " + str(repo_id)
+    helpers.log_msg(msg, 'DEBUG')
+    helpers.put_json(
+        helpers.KATELLO_API + "/repositories/" + str(repo_id), \
             json.dumps(
                 {
-                    "organization_id": org_id,
-                    "per_page": '1000',
+                    "mirror_on_sync": False
                 }
             ))
 
+
+def disable_mirror_on_sync(org_id, repos):
+    """
+    Turn off mirror-on-sync for each of the given repos that currently has it set.
+    The updates are made in parallel.
+    """
+    # Repos without the flag in the inventory are updated to be safe
+    repo_ids = [repo['id'] for repo in repos if repo.get('mirror_on_sync', True)]
+    msg = str(len(repo_ids)) + " of " + str(len(repos)) + " repos have mirror-on-sync set"
+    helpers.log_msg(msg, 'DEBUG')
+    if not repo_ids:
+        return
+    helpers.parallel_map(set_mirror_on_sync, repo_ids)
+
+    # The cached repository inventory no longer matches
+    helpers.invalidate_cache(('repos', org_id))
+
+
+def sync_content(org_id, imported_repos, prune):
+    """
+    Synchronize the repositories
+    Triggers a sync of all repositories belonging to the configured sync plan.
+    Repositories with new content are synced first, longest running first.
+    """
+    repos_to_sync = []
+    repo_details = {}
+    delete_override = False
+
+    # Get a listing of repositories in this Satellite
+    enabled_repos = helpers.get_repo_inventory(org_id)
+
     # Loop through each repo to be imported/synced
+    labels = enabled_repos.get_label_index()
     for repo in imported_repos:
-        do_import = False
-        for repo_result in enabled_repos['results']:
-            if repo in repo_result['label']:
-                do_import = True
-                repos_to_sync.append(repo_result['id'])
-
-                # Ensure Mirror-on-sync flag is set to FALSE to make sure incremental
-                # import does not (cannot) delete existing packages.
-                msg = "Setting mirror-on-sync=false for repo id " + str(repo_result['id'])
-                helpers.log_msg(msg, 'DEBUG')
-                helpers.put_json(
-                    helpers.KATELLO_API + "/repositories/" + str(repo_result['id']), \
-                        json.dumps(
-                            {
-                                "mirror_on_sync": False
-                            }
-                        ))
-
-        if do_import:
+        matches = labels.find(repo)
+        for repo_result in matches:
+            repos_to_sync.append(repo_result['id'])
+            repo_details[repo_result['id']] = repo_result
+
+        if matches:
             msg = "Repo " + repo + " found in Satellite"
             helpers.log_msg(msg, 'DEBUG')
         else:
@@ -111,6 +283,10 @@ def sync_content(org_id, imported_repos):
             helpers.log_msg(msg, 'WARNING')
             # TODO: We could go on here and try to enable the Red Hat repo .....
 
+    # Ensure Mirror-on-sync flag is set to FALSE to make sure incremental
+    # import does not (cannot) delete existing packages.
+    disable_mirror_on_sync(org_id, repo_details.values())
+
     # If we get to here and nothing was added to repos_to_sync we will abort the import.
     # This will probably occur on the initial import - nothing will be enabled in Satellite.
     # Also if there are no updates during incremental sync.
@@ -119,6 +295,20 @@ def sync_content(org_id, imported_repos):
         helpers.log_msg(msg, 'WARNING')
         return
     else:
+        # Find out how much of the imported content each repo actually needs
+        msg = "Checking imported content against Satellite"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        new_content = check_new_content(repo_details.values(), prune)
+
+        # Repos with new content are synced first, starting with those that took
+        # longest to sync last time so they do not hold up the end of the import
+        sync_times = read_sync_times()
+        repos_to_sync = sorted(repo_details, reverse=True,
+            key=lambda repo_id: (new_content.get(repo_id, 1) > 0,
+                                 sync_times.get(repo_details[repo_id]['label'], 0),
+                                 new_content.get(repo_id, 0)))
+
         msg = "Repo ids to sync: " + str(repos_to_sync)
         helpers.log_msg(msg, 'DEBUG')
 
@@ -126,35 +316,11 @@ def sync_content(org_id, imported_repos):
         helpers.log_msg(msg, 'INFO')
         print msg
 
-        # Break repos_to_sync into groups of n 
-        repochunks = [ repos_to_sync[i:i+helpers.SYNCBATCH] for i in range(0, len(repos_to_sync), helpers.SYNCBATCH) ]
+        durations = sync_repos(repos_to_sync, repo_details)
 
-        # Loop through the smaller batches of repos and sync them
-        for chunk in repochunks:
-            chunksize = len(chunk)
-            msg = "Syncing repo batch " + str(chunk)
-            helpers.log_msg(msg, 'DEBUG')
-            task_id = helpers.post_json(
-                helpers.KATELLO_API + "repositories/bulk/sync", \
-                    json.dumps(
-                        {
-                            "ids": chunk,
-                        }
-                    ))["id"]
-            msg = "Repo sync task id = " + task_id
-            helpers.log_msg(msg, 'DEBUG')
-
-            # Now we need to wait for the sync to complete
-            helpers.wait_for_task(task_id, 'sync')
-
-            tinfo = helpers.get_task_status(task_id)
-            if tinfo['state'] != 'running' and tinfo['result'] == 'success':
-                msg = "Batch of " + str(chunksize) + " repos complete"
-                helpers.log_msg(msg, 'INFO')
-                print helpers.GREEN + msg + helpers.ENDC
-            else:
-                msg = "Batch sync has errors"
-                helpers.log_msg(msg, 'WARNING')
+        # Record how long each repo took to sync, for scheduling the next import
+        sync_times.update(durations)
+        write_sync_times(sync_times)
 
         return delete_override
 
@@ -177,7 +343,7 @@ def main(args):
     global dir
     global vardir
     dir = os.path.dirname(__file__)
-    vardir = os.path.join(dir, 'var')
+    vardir = os.path.join(os.path.abspath(dir), 'var')
 
     # Log the fact we are starting
     msg = "------------- Content import started by " + runuser + " ----------------"
@@ -192,8 +358,12 @@ def main(args):
         help='Date/name of Import fileset to process (YYYY-MM-DD_NAME)', required=False)
     parser.add_argument('-n', '--nosync', help='Do not trigger a sync after extracting content',
         required=False, action="store_true")
+    parser.add_argument('-c', '--checksum', help='Verify all checksums before extracting content',
+        required=False, action="store_true")
     parser.add_argument('-r', '--remove', help='Remove input files after import has completed',
         required=False, action="store_true")
+    parser.add_argument('-p', '--prune', help='Remove packages already in Satellite before sync',
+        required=False, action="store_true")
     parser.add_argument('-l', '--last', help='Display the last successful import performed', 
         required=False, action="store_true")
     args = parser.parse_args()
@@ -230,7 +400,7 @@ def main(args):
 
 
     # Figure out if we have the specified input fileset
-    basename = get_inputfiles(expdate)
+    basename = get_inputfiles(expdate, args.checksum)
 
     # Cleanup from any previous imports
     os.system("rm -rf " + helpers.IMPORTDIR + "/{content,custom,listing,*.pkl}")
@@ -251,7 +421,7 @@ def main(args):
         imported_repos = pickle.load(open('exported_repos.pkl', 'rb'))
 
         # Run a repo sync on each imported repo
-        (delete_override) = sync_content(org_id, imported_repos)
+        (delete_override) = sync_content(org_id, imported_repos, args.prune)
 
         print helpers.GREEN + "Import complete.\n" + helpers.ENDC
         print 'Please publish content views to make new content available.'